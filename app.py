@@ -1,43 +1,128 @@
-from flask import Flask, render_template, jsonify, request, redirect, session
+from flask import (Flask, Response, abort, before_render_template, g, render_template, jsonify, request, redirect,
+                   session, template_rendered)
 from functools import wraps
-import sqlite3
-import pandas as pd
-from pathlib import Path
+import base64
+from datetime import datetime, timedelta, timezone
+import gzip
+import hashlib
+import json
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 import os
-from read_from_spotify import SpotifyAnalyzer
+import time
+import uuid
+from read_from_spotify import SpotifyAnalyzer, SyncProgress
+from db import BUMP_DATA_VERSION, UPSERT_PLAYLIST, ConnectionPool, fts_query, get_data_version, init_schema
+from cache import TTLCache
+from export import FORMATS as EXPORT_FORMATS, export_connection, iter_export
+from spotify_clients import SpotifyClients, create_session
+from scheduler import BACKGROUND, DEFAULT_BURST, DEFAULT_RATE, INTERACTIVE, RequestScheduler, request_priority
+from jobs import JobRunner
+from metrics import HTTP_REQUEST_DURATION, REGISTRY, TEMPLATE_RENDER_DURATION, RequestProfiler, request_timings
+from membership_index import MembershipIndex
+from playback import NoActiveDevice, PlaybackController, PlaybackControllers, PlaybackPoller
+from write_queue import MAX_ITEMS_PER_CALL, PlaylistWriteQueue
+from pagination import DEFAULT_MAX_WORKERS, iter_items
 import envvars
 from typing import Callable, Any, TypeVar, Optional, Dict, List
 import traceback
 
+# Brotli is optional, responses fall back to gzip without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+init_schema()
 
 # Type hints
 F = TypeVar('F', bound=Callable[..., Any])
 
+# Concurrent Spotify requests during a refresh, optionally set in envvars.py
+MAX_WORKERS = getattr(envvars, 'max_workers', DEFAULT_MAX_WORKERS)
+
+# Commit toggles locally and send them to Spotify in the background,
+# set optimistic_toggles = False in envvars.py to wait for Spotify instead
+OPTIMISTIC_TOGGLES = getattr(envvars, 'optimistic_toggles', True)
+
+# Playlist memberships of all songs, shared by every request
+membership_index = MembershipIndex()
+
+# Refreshes run in the background, one at a time
+refresh_jobs = JobRunner()
+
+# Playback commands and state, polled once per user for every open tab
+playback_controllers = PlaybackControllers()
+
+# Current user and playlists are refetched at most once per this many
+# seconds, optionally set catalogue_ttl in envvars.py. A refresh replaces
+# the cached catalogue with the one it just synced.
+CATALOGUE_TTL = getattr(envvars, 'catalogue_ttl', 600)
+catalogue_cache = TTLCache(CATALOGUE_TTL)
+
 # Spotify setup
+REDIRECT_URI = "http://localhost:8888/callback"
+SCOPE = "user-library-read user-library-modify playlist-read-private playlist-modify-public playlist-modify-private streaming user-read-playback-state user-modify-playback-state"
+
+# Every Spotify call waits for a token from this budget, interactive
+# requests first. spotify_rate_limit (requests per second) and
+# spotify_burst are optionally set in envvars.py.
+spotify_scheduler = RequestScheduler(
+    rate=getattr(envvars, 'spotify_rate_limit', DEFAULT_RATE),
+    burst=getattr(envvars, 'spotify_burst', DEFAULT_BURST)
+)
+
+# One client per logged in user, all sharing a pooled HTTP session
+spotify_clients = SpotifyClients(
+    envvars.client_id, envvars.client_secret, REDIRECT_URI, SCOPE,
+    http=create_session(scheduler=spotify_scheduler),
+    api_prefix=getattr(envvars, 'api_prefix', None)
+)
+
+# Only used for the login flow
 auth_manager = SpotifyOAuth(
     client_id=envvars.client_id,
     client_secret=envvars.client_secret,
-    redirect_uri="http://localhost:8888/callback",
-    scope="user-library-read user-library-modify playlist-read-private playlist-modify-public playlist-modify-private streaming user-read-playback-state user-modify-playback-state",
-    cache_handler=spotipy.cache_handler.FlaskSessionCacheHandler(session)
+    redirect_uri=REDIRECT_URI,
+    scope=SCOPE,
+    cache_handler=spotipy.cache_handler.FlaskSessionCacheHandler(session),
+    requests_session=spotify_clients.http
 )
 
 # Database helper class
+db_pool = ConnectionPool()
+
+# Requests are profiled with cProfile while this is on, switch it with
+# POST /api/profiler or set profile_requests = True in envvars.py
+profiler = RequestProfiler()
+profiler.enabled = getattr(envvars, 'profile_requests', False)
+
+# /metrics is served to logged in users, and to anyone, such as a Prometheus
+# scraper, only with expose_metrics = True in envvars.py
+EXPOSE_METRICS = getattr(envvars, 'expose_metrics', False)
+
+# Part of every ETag, so a restart with changed templates or code does not
+# answer with 304 for pages rendered by the previous version
+ETAG_SALT = uuid.uuid4().hex
+
+# HTML and JSON responses at least this many bytes long are compressed
+MIN_COMPRESS_SIZE = 1024
+COMPRESSIBLE_MIMETYPES = {'text/html', 'application/json', 'text/plain'}
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
 class Database:
-    def __init__(self, db_path: str = 'spotify_cache.db'):
-        self.db_path = db_path
+    def __init__(self, pool: ConnectionPool = None):
+        self.pool = pool or db_pool
 
     def __enter__(self):
-        self.conn = sqlite3.connect(self.db_path)
-        self.conn.row_factory = sqlite3.Row
+        self.conn = self.pool.acquire()
         return self.conn
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.close()
+        self.pool.release(self.conn)
 
 # Decorators
 def require_auth(f: F) -> F:
@@ -61,86 +146,376 @@ def handle_errors(f: F) -> F:
             return jsonify({'error': str(e)}), 500
     return decorated
 
+def interactive(f: F) -> F:
+    """Send the route's Spotify calls ahead of syncs and backups."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        with request_priority(INTERACTIVE):
+            return f(*args, **kwargs)
+    return decorated
+
+def versioned(key: Optional[Callable[[], Any]] = None) -> Callable[[F], F]:
+    """Answer repeated GETs with 304 until the data version changes.
+
+    The ETag combines the data version with ``key()``, for anything else
+    the response depends on. A ``key`` returning None turns caching off
+    for that request.
+    """
+    def decorator(f: F) -> F:
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            extra = key() if key else ''
+            if extra is None:
+                return f(*args, **kwargs)
+            with Database() as conn:
+                version = get_data_version(conn)
+            etag = hashlib.sha1(f"{ETAG_SALT}:{version}:{extra}".encode()).hexdigest()[:20]
+            
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = app.make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            # Weak, since the body differs by content encoding
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated
+    return decorator
+
 # Spotify client helper
+def user_key() -> str:
+    """Identify the logged in user's session across token refreshes."""
+    if 'user_key' not in session:
+        session['user_key'] = uuid.uuid4().hex
+    return session['user_key']
+
 def get_spotify() -> Optional[spotipy.Spotify]:
-    """Get spotify client, creating if needed."""
+    """Get the logged in user's long-lived spotify client.
+
+    The client does not depend on the request context, so it can also be
+    handed to worker threads.
+    """
     if not session.get('token_info'):
         return None
-    return spotipy.Spotify(auth_manager=auth_manager)
+    return spotify_clients.get(user_key(), session['token_info'])
+
+@app.after_request
+def store_refreshed_token(response):
+    """Keep the session's token in step with one the client refreshed."""
+    if session.get('token_info') and 'user_key' in session:
+        token_info = spotify_clients.token_info(session['user_key'])
+        if token_info and token_info != session['token_info']:
+            session['token_info'] = token_info
+    return response
+
+# Metrics
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    request_timings.start()
+    g.profile = profiler.start()
+
+@app.after_request
+def record_request_metrics(response):
+    """Time the request by route and report its breakdown as Server-Timing.
+
+    Streamed responses are timed until their first chunk.
+    """
+    elapsed = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_REQUEST_DURATION.observe(request.method, route, str(response.status_code), value=elapsed)
+    
+    timings = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in request_timings.finish().items()]
+    response.headers['Server-Timing'] = ', '.join(timings + [f"total;dur={elapsed * 1000:.1f}"])
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Compress large HTML and JSON responses with brotli or gzip.
+
+    Streamed responses, such as the playback event stream, and files are
+    sent as they are.
+    """
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_SIZE:
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@app.teardown_request
+def finish_profile(error=None):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profiler.finish(profile, request.method, request.full_path.rstrip('?'),
+                        time.perf_counter() - g.request_start)
+
+def start_template_timer(sender, template, context, **extra):
+    g.template_start = time.perf_counter()
+
+def record_template_time(sender, template, context, **extra):
+    elapsed = time.perf_counter() - g.pop('template_start', time.perf_counter())
+    TEMPLATE_RENDER_DURATION.observe(template.name, value=elapsed)
+    request_timings.add('render', elapsed)
+
+before_render_template.connect(start_template_timer, app)
+template_rendered.connect(record_template_time, app)
+
+# Song grid paging
+SONGS_PAGE_SIZE = 200
+SONGS_MAX_PAGE_SIZE = 1000
+
+# Sort keys of the song grid. Songs without plays sort as 0 plays and
+# as never played, so no key is ever NULL.
+SONG_SORTS = {
+    'added': "s.added_at",
+    'plays': "COALESCE(ps.play_count, 0)",
+    'last_played': "COALESCE(ps.last_played_at, '')",
+}
+
+# Largest accepted day count, well within what datetime can subtract
+MAX_FILTER_DAYS = 36500
+
+# Largest integer SQLite can bind
+MAX_SQLITE_INTEGER = 2 ** 63 - 1
+
+def int_arg(name: str, maximum: int = MAX_SQLITE_INTEGER) -> Optional[int]:
+    """Read an optional non-negative integer query parameter.
+
+    Raises ValueError with a message for the client when it is not one.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a whole number, not '{value}'") from None
+    if not 0 <= number <= maximum:
+        raise ValueError(f"{name} must be between 0 and {maximum}")
+    return number
+
+def days_ago(days: int) -> str:
+    """Format a past UTC time like SQLite's CURRENT_TIMESTAMP."""
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+def encode_cursor(sort: str, key: Any, song_id: str) -> str:
+    """Encode a (sort key, id) keyset position as an opaque cursor."""
+    return base64.urlsafe_b64encode(json.dumps([sort, key, song_id]).encode()).decode()
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    """Decode a cursor produced by encode_cursor for the same sort.
+
+    Raises ValueError for a cursor that is malformed or for another sort.
+    """
+    try:
+        cursor_sort, key, song_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        # binascii.Error and JSONDecodeError are ValueErrors too
+        raise ValueError("Invalid cursor") from None
+    if cursor_sort != sort:
+        raise ValueError(f"Cursor is for sort '{cursor_sort}', not '{sort}'")
+    # Anything else would fail to bind, or overflow, in the page query
+    if (not isinstance(song_id, str) or not isinstance(key, (str, int)) or isinstance(key, bool)
+            or isinstance(key, int) and abs(key) > MAX_SQLITE_INTEGER):
+        raise ValueError("Invalid cursor")
+    return key, song_id
+
+# Playlist catalogue
+def build_catalogue(user_id: str, playlists: List[Dict]) -> Dict:
+    """Keep the user id and the owned playlists in Spotify's order."""
+    return {
+        'user_id': user_id,
+        'playlists': [
+            {'id': playlist['id'], 'name': playlist['name']}
+            for playlist in playlists
+            if playlist['owner']['id'] == user_id
+        ]
+    }
+
+def load_catalogue() -> Dict:
+    """Fetch the current user and every page of their playlists."""
+    spotify = get_spotify()
+    user_id = spotify.current_user()['id']
+    playlists = list(iter_items(
+        lambda offset, limit: spotify.current_user_playlists(limit=limit, offset=offset),
+        limit=50,
+        max_workers=MAX_WORKERS
+    ))
+    
+    with Database() as conn:
+        changes = conn.total_changes
+        conn.executemany(UPSERT_PLAYLIST, [
+            (playlist['id'], playlist['name'], playlist['owner']['id'])
+            for playlist in playlists
+        ])
+        # Unchanged playlists are not rewritten, so cached pages stay valid
+        if conn.total_changes > changes:
+            conn.execute(BUMP_DATA_VERSION)
+        conn.commit()
+    
+    return build_catalogue(user_id, playlists)
+
+def index_key() -> Optional[str]:
+    """The main page embeds the user's playlists and access token.
+
+    The catalogue is loaded first, since loading it bumps the data version.
+    Pages with a token about to expire are rendered again to get a new one.
+    """
+    catalogue_cache.get_or_load(user_key(), load_catalogue)
+    token_info = session['token_info']
+    if token_info.get('expires_at', 0) - 60 < time.time():
+        return None
+    return f"{user_key()}:{token_info.get('access_token')}"
 
 # Route handlers
 @app.route('/')
 @require_auth
 @handle_errors
+@versioned(index_key)
 def index():
-    """Render the main page with song data."""
-    spotify = get_spotify()
-    user_info = spotify.current_user()
-    user_id = user_info['id']
+    """Render the main page, song rows are loaded from /api/songs.
+
+    Playlists come from the catalogue cache, so a page load only calls
+    Spotify once the cached catalogue has expired.
+    """
+    catalogue = catalogue_cache.get_or_load(user_key(), load_catalogue)
     
     with Database() as conn:
-        # Get basic data
-        songs = conn.execute('SELECT * FROM liked_songs ORDER BY added_at DESC').fetchall()
-        playlists = spotify.current_user_playlists()
-        
-        # Process playlists
-        owned_playlists = []
-        for playlist in playlists['items']:
-            if playlist['owner']['id'] == user_id:
-                owned_playlists.append({
-                    'id': playlist['id'],
-                    'name': playlist['name']
-                })
-                conn.execute("""
-                    INSERT OR REPLACE INTO playlists (id, name, owner_id)
-                    VALUES (?, ?, ?)
-                """, (playlist['id'], playlist['name'], user_id))
-        
-        # Get memberships for owned playlists
-        owned_playlist_ids = [p['id'] for p in owned_playlists]
-        if owned_playlist_ids:
-            placeholders = ','.join('?' * len(owned_playlist_ids))
-            memberships = conn.execute(
-                f"SELECT * FROM playlist_songs WHERE playlist_id IN ({placeholders})",
-                owned_playlist_ids
-            ).fetchall()
-        else:
-            memberships = []
-            
-        # Get played songs
-        played_songs = conn.execute(
-            "SELECT DISTINCT song_id FROM played_history"
-        ).fetchall()
-        
-        conn.commit()
-
-    # Process data for template
-    songs_list = [dict(s) for s in songs]
-    memberships_set = {(m['song_id'], m['playlist_id']) for m in memberships}
-    played_songs_set = {s['song_id'] for s in played_songs}
+        song_count = conn.execute("SELECT COUNT(*) FROM liked_songs").fetchone()[0]
     
     # Add special "Liked Songs" playlist
     liked_songs_playlist = {'id': 'liked_songs', 'name': '❤️ Liked Songs'}
-    owned_playlists.insert(0, liked_songs_playlist)
+    playlists = [liked_songs_playlist] + catalogue['playlists']
     
     # Get fresh token
-    token = auth_manager.get_cached_token()['access_token']
-    
-    # Helper function for template
-    def song_in_playlist(song_id: str, playlist_id: str) -> bool:
-        if playlist_id == 'liked_songs':
-            return True
-        return (song_id, playlist_id) in memberships_set
+    token = get_spotify().auth_manager.get_access_token(as_dict=False)
     
     return render_template(
         'index.html',
-        songs=songs_list,
-        playlists=owned_playlists,
-        song_in_playlist=song_in_playlist,
-        song_was_played=lambda s: s in played_songs_set,
+        playlists=playlists,
+        song_count=song_count,
+        page_size=SONGS_PAGE_SIZE,
         spotify_token=token
     )
 
+def songs_key() -> Optional[str]:
+    """Recency filters depend on the time as well, so they are not cached."""
+    if 'played_within_days' in request.args or 'not_played_within_days' in request.args:
+        return None
+    return request.full_path
+
+@app.route('/api/songs')
+@app.route('/api/search')
+@require_auth
+@handle_errors
+@versioned(songs_key)
+def list_songs():
+    """Return a page of liked songs, newest first unless sorted otherwise.
+
+    Each row is ``[id, name, artist, play_count, mask, last_played_at]`` where
+    ``mask`` is a hex bitmask over the returned ``playlists``: bit ``i`` is
+    set when the song is in ``playlists[i]``. Pass ``next_cursor`` back as
+    ``cursor`` to get the following page; it is null on the last page.
+
+    Optional parameters, all combinable:
+
+    - ``sort``: ``added``, ``plays`` or ``last_played``, with ``order``
+      ``desc`` (default) or ``asc``
+    - ``q``: every word must match the start of a word in the name or artist
+    - ``in_playlist``: a playlist id; ``no_playlist=1`` for songs in none
+    - ``unplayed=1``, ``min_plays``, ``max_plays``
+    - ``played_within_days`` and ``not_played_within_days``
+    """
+    args = request.args
+    limit = max(1, min(args.get('limit', SONGS_PAGE_SIZE, type=int), SONGS_MAX_PAGE_SIZE))
+    sort = args.get('sort', 'added')
+    if sort not in SONG_SORTS:
+        return jsonify({'error': f"Unknown sort '{sort}'"}), 400
+    sort_key = SONG_SORTS[sort]
+    descending = args.get('order', 'desc') != 'asc'
+    
+    try:
+        min_plays = int_arg('min_plays')
+        max_plays = int_arg('max_plays')
+        played_within_days = int_arg('played_within_days', MAX_FILTER_DAYS)
+        not_played_within_days = int_arg('not_played_within_days', MAX_FILTER_DAYS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    conditions = []
+    params = []
+    match = fts_query(args.get('q', ''))
+    if match:
+        conditions.append("s.rowid IN (SELECT rowid FROM liked_songs_fts WHERE liked_songs_fts MATCH ?)")
+        params.append(match)
+    if args.get('in_playlist'):
+        conditions.append("s.id IN (SELECT song_id FROM playlist_songs WHERE playlist_id = ?)")
+        params.append(args['in_playlist'])
+    if args.get('no_playlist', type=int):
+        conditions.append("NOT EXISTS (SELECT 1 FROM playlist_songs p WHERE p.song_id = s.id)")
+    if args.get('unplayed', type=int):
+        conditions.append("ps.song_id IS NULL")
+    if min_plays is not None:
+        conditions.append("COALESCE(ps.play_count, 0) >= ?")
+        params.append(min_plays)
+    if max_plays is not None:
+        conditions.append("COALESCE(ps.play_count, 0) <= ?")
+        params.append(max_plays)
+    if played_within_days is not None:
+        conditions.append("ps.last_played_at >= ?")
+        params.append(days_ago(played_within_days))
+    if not_played_within_days is not None:
+        conditions.append("COALESCE(ps.last_played_at, '') < ?")
+        params.append(days_ago(not_played_within_days))
+    if args.get('cursor'):
+        conditions.append(f"({sort_key}, s.id) {'<' if descending else '>'} (?, ?)")
+        try:
+            params.extend(decode_cursor(args['cursor'], sort))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    direction = 'DESC' if descending else 'ASC'
+    with Database() as conn:
+        songs = conn.execute(f"""
+            SELECT s.id, s.name, s.artist, {sort_key} AS sort_key,
+                   COALESCE(ps.play_count, 0) AS play_count, ps.last_played_at
+            FROM liked_songs s
+            LEFT JOIN play_stats ps ON ps.song_id = s.id
+            {where}
+            ORDER BY sort_key {direction}, s.id {direction}
+            LIMIT ?
+        """, (*params, limit)).fetchall()
+    
+    playlist_ids, masks = membership_index.masks([song['id'] for song in songs])
+    
+    next_cursor = None
+    if len(songs) == limit:
+        next_cursor = encode_cursor(sort, songs[-1]['sort_key'], songs[-1]['id'])
+    
+    return jsonify({
+        'playlists': playlist_ids,
+        'songs': [
+            [s['id'], s['name'], s['artist'], s['play_count'], format(mask, 'x'), s['last_played_at']]
+            for s, mask in zip(songs, masks)
+        ],
+        'next_cursor': next_cursor
+    })
+
 @app.route('/login')
 def login():
     """Handle login flow."""
@@ -160,12 +535,17 @@ def callback():
 @app.route('/api/toggle_playlist', methods=['POST'])
 @require_auth
 @handle_errors
+@interactive
 def toggle_playlist():
-    """Add or remove a song from a playlist."""
-    spotify = get_spotify()
+    """Add or remove a song from a playlist.
+
+    With optimistic toggles the local change is committed and returned at
+    once, and the Spotify call is left to the write-behind queue.
+    """
     data = request.json
     song_id = data['song_id']
     playlist_id = data['playlist_id']
+    spotify = None if OPTIMISTIC_TOGGLES else get_spotify()
     
     with Database() as conn:
         exists = conn.execute("""
@@ -174,64 +554,92 @@ def toggle_playlist():
         """, (song_id, playlist_id)).fetchone()
         
         if exists:
-            spotify.playlist_remove_all_occurrences_of_items(
-                playlist_id=playlist_id,
-                items=[song_id]
-            )
+            if spotify:
+                spotify.playlist_remove_all_occurrences_of_items(
+                    playlist_id=playlist_id,
+                    items=[song_id]
+                )
             conn.execute("""
                 DELETE FROM playlist_songs 
                 WHERE song_id = ? AND playlist_id = ?
             """, (song_id, playlist_id))
+            conn.execute(BUMP_DATA_VERSION)
+            with membership_index.locked():
+                conn.commit()
+                membership_index.remove(song_id, playlist_id)
         else:
-            spotify.playlist_add_items(
-                playlist_id=playlist_id,
-                items=[song_id]
-            )
+            if spotify:
+                spotify.playlist_add_items(
+                    playlist_id=playlist_id,
+                    items=[song_id]
+                )
             conn.execute("""
                 INSERT INTO playlist_songs (song_id, playlist_id)
                 VALUES (?, ?)
             """, (song_id, playlist_id))
-        
-        conn.commit()
+            conn.execute(BUMP_DATA_VERSION)
+            with membership_index.locked():
+                conn.commit()
+                membership_index.add(song_id, playlist_id)
+    
+    if OPTIMISTIC_TOGGLES:
+        write_queue.enqueue(get_spotify(), playlist_id, song_id, add=not exists)
     
     return jsonify({'status': 'success', 'in_playlist': not exists})
 
+@app.route('/api/pending_writes')
+@require_auth
+@handle_errors
+def pending_writes():
+    """Report playlist toggles that have not reached Spotify yet."""
+    return jsonify(write_queue.status())
+
+def rollback_toggles(playlist_id: str, song_ids: List[str], added: bool):
+    """Undo the local side of toggles that could not be applied on Spotify."""
+    with Database() as conn:
+        if added:
+            conn.executemany("""
+                DELETE FROM playlist_songs
+                WHERE song_id = ? AND playlist_id = ?
+            """, [(song_id, playlist_id) for song_id in song_ids])
+        else:
+            conn.executemany("""
+                INSERT OR IGNORE INTO playlist_songs (song_id, playlist_id)
+                VALUES (?, ?)
+            """, [(song_id, playlist_id) for song_id in song_ids])
+        conn.execute(BUMP_DATA_VERSION)
+        with membership_index.locked():
+            conn.commit()
+            for song_id in song_ids:
+                if added:
+                    membership_index.remove(song_id, playlist_id)
+                else:
+                    membership_index.add(song_id, playlist_id)
+
+write_queue = PlaylistWriteQueue(on_failure=rollback_toggles)
+
 @app.route('/api/play', methods=['POST'])
 @require_auth
 @handle_errors
+@interactive
 def play_song():
     """Start playback of a specific song."""
-    spotify = get_spotify()
     song_id = request.json['song_id']
-    
-    # Get available devices
-    devices = spotify.devices()
-    if not devices['devices']:
-        return jsonify({'error': 'No active devices found'}), 400
-    
-    # Find active device
-    active_devices = [d for d in devices['devices'] if d['is_active']]
-    device_id = active_devices[0]['id'] if active_devices else devices['devices'][0]['id']
-    
-    # Start playback
-    spotify.start_playback(
-        device_id=device_id,
-        uris=[f'spotify:track:{song_id}']
-    )
+    try:
+        get_playback().play(song_id)
+    except NoActiveDevice as e:
+        return jsonify({'error': str(e)}), 400
     
     return jsonify({'status': 'success'})
 
 @app.route('/api/stop', methods=['POST'])
 @require_auth
 @handle_errors
+@interactive
 def stop_playback():
     """Stop current playback."""
-    spotify = get_spotify()
     try:
-        # Only try to stop if something is actually playing
-        playback = spotify.current_playback()
-        if playback and playback['is_playing']:
-            spotify.pause_playback()
+        get_playback().pause()
     except Exception as e:
         print(f"Error stopping playback: {e}")
         # Don't error out - the UI can handle it
@@ -246,46 +654,118 @@ def mark_played():
     """Mark a song as played."""
     song_id = request.json['song_id']
     
+    # A trigger updates play_stats in the same transaction. Repeated marks
+    # within the same second count as one play.
     with Database() as conn:
-        conn.execute("""
-            INSERT INTO played_history (song_id)
+        cursor = conn.execute("""
+            INSERT OR IGNORE INTO played_history (song_id)
             VALUES (?)
         """, (song_id,))
+        # An ignored duplicate changed nothing, so cached responses stay valid
+        if cursor.rowcount > 0:
+            conn.execute(BUMP_DATA_VERSION)
         conn.commit()
     
     return jsonify({'status': 'success'})
 
+# Added and removed items listed per kind in a refresh job's result
+REFRESH_REPORT_LIMIT = 100
+
+def run_refresh(progress: SyncProgress, spotify: spotipy.Spotify, key: str, full_resync: bool) -> Dict:
+    """Sync the local database with Spotify, run as a background job.
+
+    Returns how many songs and playlists were added and removed, with the
+    first ``REFRESH_REPORT_LIMIT`` of each. Playlists with toggles still
+    unsent after waiting for the write queue are listed as ``unsent_toggles``.
+    """
+    analyzer = SpotifyAnalyzer(
+        spotify_client=spotify,
+        max_workers=MAX_WORKERS,
+        membership_index=membership_index,
+        progress=progress
+    )
+    
+    # Queued toggles must reach Spotify before playlists are re-read
+    progress.start_stage('pending_writes')
+    unsent = []
+    if not write_queue.drain(timeout=60):
+        # The sync overwrites these toggles locally until they are sent
+        unsent = [
+            {'playlist_id': playlist_id, **ops}
+            for playlist_id, ops in write_queue.status()['pending_by_playlist'].items()
+        ]
+        print(f"Refreshing with toggles for {len(unsent)} playlists not yet sent to Spotify")
+    
+    catalogue_cache.invalidate(key)
+    
+    # Clicks made during the sync go first
+    with request_priority(BACKGROUND):
+        analyzer.fetch_all_liked_songs(full_resync=full_resync)
+        analyzer.fetch_all_playlists(full_resync=full_resync)
+    
+    catalogue_cache.set(key, build_catalogue(analyzer.user_id, analyzer.playlists))
+    
+    report = dict(analyzer.report)
+    if unsent:
+        report['unsent_toggles'] = unsent
+    return {
+        kind: {'count': len(items), 'items': items[:REFRESH_REPORT_LIMIT]}
+        for kind, items in report.items()
+    }
+
 @app.route('/api/refresh', methods=['POST'])
 @require_auth
 @handle_errors
 def refresh_data():
-    """Refresh all data from Spotify."""
+    """Start refreshing all data from Spotify in the background.
+
+    Liked songs and unchanged playlists are synced incrementally unless the
+    request body contains ``{"full": true}``. While a refresh is running,
+    further requests get that job instead of starting another one. Poll
+    ``/api/refresh/<job_id>`` for progress.
+    """
+    full_resync = bool((request.get_json(silent=True) or {}).get('full'))
+    key = user_key()
     spotify = get_spotify()
-    analyzer = SpotifyAnalyzer(spotify_client=spotify)
     
-    analyzer.cleanup_deleted_items()
-    analyzer.fetch_all_liked_songs()
-    analyzer.fetch_all_playlists()
-    
-    return jsonify({'status': 'success'})
+    # The cache database is shared, so there is one refresh at a time
+    job, started = refresh_jobs.start(
+        'refresh', lambda progress: run_refresh(progress, spotify, key, full_resync)
+    )
+    return jsonify({**job.snapshot(), 'started': started}), 202
+
+@app.route('/api/refresh/<job_id>')
+@require_auth
+@handle_errors
+def refresh_progress(job_id):
+    """Report the progress of a refresh job."""
+    job = refresh_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/api/refresh/<job_id>/cancel', methods=['POST'])
+@require_auth
+@handle_errors
+def cancel_refresh(job_id):
+    """Stop a refresh job at its next page or playlist."""
+    job = refresh_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job.snapshot())
 
 @app.route('/api/seek', methods=['POST'])
 @require_auth
 @handle_errors
+@interactive
 def seek_playback():
     """Seek forward/backward in current playback."""
-    spotify = get_spotify()
     position_ms = request.json['position_ms']
+    try:
+        new_position = get_playback().seek(position_ms)
+    except NoActiveDevice as e:
+        return jsonify({'error': str(e)}), 400
     
-    playback = spotify.current_playback()
-    if not playback:
-        return jsonify({'error': 'No active playback'}), 400
-    
-    current_ms = playback['progress_ms']
-    track_duration = playback['item']['duration_ms']
-    new_position = max(0, min(current_ms + position_ms, track_duration))
-    
-    spotify.seek_track(new_position)
     return jsonify({'status': 'success', 'new_position': new_position})
 
 @app.route('/api/unlike_song', methods=['POST'])
@@ -308,26 +788,215 @@ def like_song():
     spotify.current_user_saved_tracks_add([song_id])
     return jsonify({'status': 'success'})
 
+# Spotify saves or removes at most 50 liked songs per call
+LIBRARY_ITEMS_PER_CALL = 50
+
+# Songs accepted by one bulk request, keep BULK_CHUNK_SIZE in
+# static/js/playlist-manager.js in step
+MAX_BULK_SONGS = 10000
+
+def bulk_song_ids(data: Dict) -> List[str]:
+    """Read the deduplicated ``song_ids`` list of a bulk request."""
+    song_ids = data.get('song_ids')
+    if not isinstance(song_ids, list) or not all(isinstance(song_id, str) for song_id in song_ids):
+        raise ValueError("song_ids must be a list of song ids")
+    song_ids = list(dict.fromkeys(song_ids))
+    if len(song_ids) > MAX_BULK_SONGS:
+        raise ValueError(f"At most {MAX_BULK_SONGS} songs per request")
+    return song_ids
+
+@app.route('/api/bulk/playlists', methods=['POST'])
+@require_auth
+@handle_errors
+@interactive
+def bulk_set_playlists():
+    """Add several songs to several playlists, or remove them.
+
+    The body is ``{"song_ids": [...], "playlist_ids": [...], "in_playlist":
+    true}``. Only pairs whose state changes are written: locally in one
+    transaction, and on Spotify in calls of up to 100 songs per playlist,
+    through the write-behind queue with optimistic toggles.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        song_ids = bulk_song_ids(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    playlist_ids = data.get('playlist_ids')
+    if (not isinstance(playlist_ids, list) or 'liked_songs' in playlist_ids
+            or not all(isinstance(playlist_id, str) for playlist_id in playlist_ids)):
+        return jsonify({'error': 'playlist_ids must be a list of playlist ids'}), 400
+    playlist_ids = list(dict.fromkeys(playlist_ids))
+    add = bool(data.get('in_playlist', True))
+    spotify = get_spotify()
+    
+    changes = {}
+    with Database() as conn:
+        for playlist_id in playlist_ids:
+            members = {row[0] for row in conn.execute(
+                "SELECT song_id FROM playlist_songs WHERE playlist_id = ?", (playlist_id,)
+            )}
+            changed = [song_id for song_id in song_ids if (song_id in members) != add]
+            if changed:
+                changes[playlist_id] = changed
+        
+        if not OPTIMISTIC_TOGGLES:
+            for playlist_id, changed in changes.items():
+                for start in range(0, len(changed), MAX_ITEMS_PER_CALL):
+                    chunk = changed[start:start + MAX_ITEMS_PER_CALL]
+                    if add:
+                        spotify.playlist_add_items(playlist_id=playlist_id, items=chunk)
+                    else:
+                        spotify.playlist_remove_all_occurrences_of_items(playlist_id=playlist_id, items=chunk)
+        
+        pairs = [(song_id, playlist_id) for playlist_id, changed in changes.items() for song_id in changed]
+        if add:
+            conn.executemany("""
+                INSERT OR IGNORE INTO playlist_songs (song_id, playlist_id)
+                VALUES (?, ?)
+            """, pairs)
+        else:
+            conn.executemany("""
+                DELETE FROM playlist_songs
+                WHERE song_id = ? AND playlist_id = ?
+            """, pairs)
+        conn.execute(BUMP_DATA_VERSION)
+        # Requests that see the new version must also see the new masks
+        with membership_index.locked():
+            conn.commit()
+            for song_id, playlist_id in pairs:
+                if add:
+                    membership_index.add(song_id, playlist_id)
+                else:
+                    membership_index.remove(song_id, playlist_id)
+    
+    if OPTIMISTIC_TOGGLES:
+        for playlist_id, changed in changes.items():
+            write_queue.enqueue_many(spotify, playlist_id, changed, add)
+    
+    return jsonify({
+        'status': 'success',
+        'in_playlist': add,
+        'changed': {playlist_id: len(changed) for playlist_id, changed in changes.items()}
+    })
+
+@app.route('/api/bulk/liked', methods=['POST'])
+@require_auth
+@handle_errors
+@interactive
+def bulk_set_liked():
+    """Like or unlike several songs, ``{"song_ids": [...], "liked": false}``.
+
+    Songs are sent in calls of up to 50. Like ``unlike_song``, this leaves
+    the local library alone so unliked songs can be liked again until the
+    next refresh.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        song_ids = bulk_song_ids(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    liked = bool(data.get('liked', True))
+    spotify = get_spotify()
+    
+    for start in range(0, len(song_ids), LIBRARY_ITEMS_PER_CALL):
+        chunk = song_ids[start:start + LIBRARY_ITEMS_PER_CALL]
+        if liked:
+            spotify.current_user_saved_tracks_add(chunk)
+        else:
+            spotify.current_user_saved_tracks_delete(chunk)
+    
+    return jsonify({'status': 'success', 'liked': liked, 'changed': len(song_ids)})
+
+def get_playback() -> PlaybackController:
+    """Get the playback controller shared by all of the user's tabs."""
+    return playback_controllers.get(user_key(), get_spotify())
+
+def get_poller() -> PlaybackPoller:
+    """Get the playback poller shared by all of the user's tabs."""
+    return get_playback().poller
+
 @app.route('/api/playback_status')
 @require_auth
 @handle_errors
 def get_playback_status():
     """Get current playback status."""
-    spotify = get_spotify()
-    playback = spotify.current_playback()
+    return jsonify(get_poller().status())
+
+@app.route('/api/playback_stream')
+@require_auth
+def playback_stream():
+    """Push playback status changes as Server-Sent Events."""
+    poller = get_poller()
     
-    if not playback or not playback['is_playing']:
-        return jsonify({
-            'is_playing': False,
-            'progress_ms': 0,
-            'duration_ms': 0
-        })
+    def events():
+        for state in poller.subscribe():
+            if state is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"data: {json.dumps(state)}\n\n"
     
-    return jsonify({
-        'is_playing': playback['is_playing'],
-        'progress_ms': playback['progress_ms'],
-        'duration_ms': playback['item']['duration_ms']
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
     })
 
+@app.route('/api/export')
+@require_auth
+@handle_errors
+def export_library():
+    """Download the song x playlist matrix of the user's playlists.
+
+    ``format`` is ``csv`` (default), ``ndjson`` or ``long``. Rows are streamed
+    from SQLite as they are read, so the download starts at once and memory
+    use does not grow with the library.
+    """
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown format, expected one of {', '.join(EXPORT_FORMATS)}"}), 400
+    user_id = catalogue_cache.get_or_load(user_key(), load_catalogue)['user_id']
+    mimetype, filename = EXPORT_FORMATS[fmt]
+    
+    def chunks():
+        # Closed with the response, also when the client goes away
+        with export_connection() as conn:
+            yield from iter_export(conn, user_id, fmt)
+    
+    return Response(chunks(), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={filename}',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Expose route, Spotify, SQLite and sync metrics for Prometheus."""
+    if not EXPOSE_METRICS and not session.get('token_info'):
+        abort(404)
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/scheduler')
+@require_auth
+@handle_errors
+def scheduler_status():
+    """Report the Spotify request budget, queued requests and wait times."""
+    return jsonify(spotify_scheduler.status())
+
+@app.route('/api/profiler', methods=['GET', 'POST'])
+@require_auth
+@handle_errors
+def request_profiler():
+    """Show the latest request profiles, or switch profiling on and off.
+
+    POST ``{"enabled": true}`` to profile the following requests and
+    ``{"clear": true}`` to drop the collected profiles.
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if 'enabled' in data:
+            profiler.enabled = bool(data['enabled'])
+        if data.get('clear'):
+            profiler.clear()
+    return jsonify({'enabled': profiler.enabled, 'profiles': profiler.profiles()})
+
 if __name__ == '__main__':
     app.run(debug=True, port=8888)
\ No newline at end of file
@@ -1,92 +1,254 @@
-
-
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
+import argparse
+import gzip
 import json
+import os
 from datetime import datetime
 from pathlib import Path
 import logging
+from typing import Dict, Iterator, List, Optional, Set
 import envvars
+from pagination import DEFAULT_MAX_WORKERS, iter_items, map_in_order
+from scheduler import BACKGROUND, DEFAULT_BURST, DEFAULT_RATE, RequestScheduler, request_priority
+from spotify_clients import create_session
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def backup_playlists(sp):
-    """Backup all playlists and their tracks."""
-    backup = {}
-    
-    # Get all user playlists
-    playlists = sp.current_user_playlists()
-    logger.info(f"Found {playlists['total']} playlists")
-    
-    while playlists:
-        for playlist in playlists['items']:
-            playlist_id = playlist['id']
-            playlist_name = playlist['name']
-            
-            # Get all tracks for this playlist
-            tracks = []
-            results = sp.playlist_tracks(playlist_id)
-            
-            while results:
-                for item in results['items']:
-                    if item['track']:  # Some tracks might be None due to availability
-                        track = item['track']
-                        tracks.append({
-                            'id': track['id'],
-                            'name': track['name'],
-                            'artist': track['artists'][0]['name'] if track['artists'] else 'Unknown',
-                            'added_at': item['added_at']
-                        })
-                
-                if results['next']:
-                    results = sp.next(results)
-                else:
-                    results = None
-            
-            backup[playlist_name] = {
-                'id': playlist_id,
-                'tracks': tracks
-            }
-            logger.info(f"Backed up playlist '{playlist_name}' with {len(tracks)} tracks")
-        
-        if playlists['next']:
-            playlists = sp.next(playlists)
+BACKUP_DIR = Path('backups')
+FORMAT_VERSION = 2
+
+def fetch_playlist_tracks(sp, playlist_id, max_workers=DEFAULT_MAX_WORKERS, keep_unavailable=False):
+    """Fetch the available tracks of a single playlist.
+
+    With ``keep_unavailable`` items without a track id are returned as None
+    instead of skipped, so list positions match Spotify's.
+    """
+    tracks = []
+    items = iter_items(
+        lambda offset, limit: sp.playlist_tracks(playlist_id, limit=limit, offset=offset),
+        limit=100,
+        max_workers=max_workers
+    )
+    for item in items:
+        # Some tracks might be None due to availability, local files have no id
+        if item['track'] and item['track']['id']:
+            track = item['track']
+            tracks.append({
+                'id': track['id'],
+                'name': track['name'],
+                'artist': track['artists'][0]['name'] if track['artists'] else 'Unknown',
+                'added_at': item['added_at']
+            })
+        elif keep_unavailable:
+            tracks.append(None)
+    return tracks
+
+class BackupWriter:
+    """Write a backup as gzip-compressed NDJSON, one record per line.
+
+    The first line describes the backup. A track's name and artist are
+    written once, in a ``track`` record before the first playlist that
+    contains it; ``playlist`` records list their tracks as ``[id, added_at]``
+    pairs in playlist order. The file only gets its final name on a clean
+    close, so an interrupted backup never serves as the base of the next one.
+    """
+
+    def __init__(self, path: Path, base: Optional[Path] = None):
+        self.path = path
+        self._partial = path.with_name(path.name + '.part')
+        self._file = gzip.open(self._partial, 'wt', encoding='utf-8')
+        self._seen_tracks: Set[str] = set()
+        self._write({
+            'type': 'backup',
+            'version': FORMAT_VERSION,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'base': base.name if base else None
+        })
+
+    def _write(self, record: Dict):
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+        self._file.write('\n')
+
+    def add_track(self, track: Dict):
+        """Write a track record unless the track was written before."""
+        if track['id'] in self._seen_tracks:
+            return
+        self._seen_tracks.add(track['id'])
+        self._write({'type': 'track', 'id': track['id'], 'name': track['name'], 'artist': track['artist']})
+
+    def add_playlist(self, playlist: Dict, tracks: List[Dict]):
+        """Write a playlist and the tracks not yet in the backup."""
+        for track in tracks:
+            self.add_track(track)
+        self._write({
+            'type': 'playlist',
+            'id': playlist['id'],
+            'name': playlist['name'],
+            'owner_id': playlist['owner_id'],
+            'snapshot_id': playlist['snapshot_id'],
+            'tracks': [[track['id'], track['added_at']] for track in tracks]
+        })
+
+    def add_playlist_record(self, record: Dict):
+        """Copy a playlist record whose tracks were already added."""
+        self._write(record)
+
+    def close(self):
+        self._file.close()
+        os.replace(self._partial, self.path)
+
+    def abort(self):
+        self._file.close()
+        self._partial.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
         else:
-            playlists = None
-    
-    return backup
+            self.abort()
+
+def iter_backup(path: Path) -> Iterator[Dict]:
+    """Yield the records of a backup file.
+
+    Backups in the older JSON format, a dict of playlists keyed by name, are
+    converted to the same records on the fly.
+    """
+    if path.suffix == '.json':
+        with open(path, encoding='utf-8') as f:
+            legacy = json.load(f)
+        seen_tracks = set()
+        for name, data in legacy.items():
+            tracks = [track for track in data['tracks'] if track['id']]
+            for track in tracks:
+                if track['id'] not in seen_tracks:
+                    seen_tracks.add(track['id'])
+                    yield {'type': 'track', 'id': track['id'], 'name': track['name'], 'artist': track['artist']}
+            yield {
+                'type': 'playlist',
+                'id': data['id'],
+                'name': name,
+                'owner_id': None,
+                'snapshot_id': None,
+                'tracks': [[track['id'], track['added_at']] for track in tracks]
+            }
+        return
+
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def find_latest_backup(backup_dir: Path = BACKUP_DIR) -> Optional[Path]:
+    """Return the newest complete NDJSON backup, if any."""
+    backups = sorted(backup_dir.glob('spotify_backup_*.ndjson.gz'))
+    return backups[-1] if backups else None
+
+def copy_unchanged_playlists(writer: BackupWriter, base: Path, snapshots: Dict[str, str]) -> Set[str]:
+    """Copy playlists whose snapshot matches ``snapshots`` from an older backup.
+
+    The first pass finds the unchanged playlists and the tracks they need,
+    the second copies those records, so neither holds the backup in memory.
+    Returns the ids of the copied playlists.
+    """
+    unchanged = set()
+    needed_tracks = set()
+    for record in iter_backup(base):
+        if (record['type'] == 'playlist' and record['snapshot_id']
+                and snapshots.get(record['id']) == record['snapshot_id']):
+            unchanged.add(record['id'])
+            needed_tracks.update(track_id for track_id, _ in record['tracks'])
+
+    for record in iter_backup(base):
+        if record['type'] == 'track' and record['id'] in needed_tracks:
+            writer.add_track(record)
+        elif record['type'] == 'playlist' and record['id'] in unchanged:
+            writer.add_playlist_record(record)
+            logger.info(f"Kept playlist '{record['name']}' with {len(record['tracks'])} tracks from {base.name}")
+    return unchanged
+
+def backup_playlists(sp, writer: BackupWriter, max_workers=DEFAULT_MAX_WORKERS, base: Optional[Path] = None):
+    """Backup all playlists and their tracks.
+
+    Playlist pages and the tracks of several playlists are fetched
+    concurrently, with at most ``max_workers`` requests in flight. Each
+    playlist's tracks are paged serially within that pool.
+    Each playlist is written as soon as it is fetched. With a ``base``
+    backup, playlists whose ``snapshot_id`` did not change are copied from it
+    instead of downloaded. Returns the number of playlists and how many of
+    them were copied.
+    """
+    # Get all user playlists
+    playlists = [{
+        'id': playlist['id'],
+        'name': playlist['name'],
+        'owner_id': playlist['owner']['id'],
+        'snapshot_id': playlist.get('snapshot_id')
+    } for playlist in iter_items(
+        lambda offset, limit: sp.current_user_playlists(limit=limit, offset=offset),
+        limit=50,
+        max_workers=max_workers
+    )]
+    logger.info(f"Found {len(playlists)} playlists")
+
+    unchanged = set()
+    if base:
+        unchanged = copy_unchanged_playlists(
+            writer, base, {playlist['id']: playlist['snapshot_id'] for playlist in playlists}
+        )
+    changed = [playlist for playlist in playlists if playlist['id'] not in unchanged]
+    logger.info(f"Downloading {len(changed)} playlists, {len(unchanged)} unchanged")
+
+    all_tracks = map_in_order(
+        lambda playlist: fetch_playlist_tracks(sp, playlist['id'], max_workers=1),
+        changed,
+        max_workers
+    )
+    for playlist, tracks in zip(changed, all_tracks):
+        writer.add_playlist(playlist, tracks)
+        logger.info(f"Backed up playlist '{playlist['name']}' with {len(tracks)} tracks")
+
+    return len(playlists), len(unchanged)
 
 def main():
+    parser = argparse.ArgumentParser(description='Back up all playlists to a gzip-compressed NDJSON file.')
+    parser.add_argument('--full', action='store_true',
+                        help='download every playlist instead of reusing unchanged ones from the last backup')
+    parser.add_argument('--output-dir', type=Path, default=BACKUP_DIR)
+    args = parser.parse_args()
+
     # Configure Spotify client
+    # Backups run at background priority within their own request budget
     sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
     client_id = envvars.client_id,
     client_secret = envvars.client_secret,
     redirect_uri="http://localhost:8888/callback",
     scope="playlist-read-private playlist-read-collaborative"
-    ))
-    
-    # Create backup
-    backup = backup_playlists(sp)
-    
+    ), requests_session=create_session(scheduler=RequestScheduler(
+        rate=getattr(envvars, 'spotify_rate_limit', DEFAULT_RATE),
+        burst=getattr(envvars, 'spotify_burst', DEFAULT_BURST)
+    )))
+
     # Create backup directory if it doesn't exist
-    backup_dir = Path('backups')
-    backup_dir.mkdir(exist_ok=True)
-    
+    args.output_dir.mkdir(exist_ok=True)
+    base = None if args.full else find_latest_backup(args.output_dir)
+    if base:
+        logger.info(f"Incremental backup based on {base}")
+
     # Save backup with timestamp
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_file = backup_dir / f'spotify_backup_{timestamp}.json'
-    
-    with open(backup_file, 'w', encoding='utf-8') as f:
-        json.dump(backup, f, indent=2, ensure_ascii=False)
-    
+    backup_file = args.output_dir / f'spotify_backup_{timestamp}.ndjson.gz'
+
+    with BackupWriter(backup_file, base) as writer, request_priority(BACKGROUND):
+        total, unchanged = backup_playlists(sp, writer, getattr(envvars, 'max_workers', DEFAULT_MAX_WORKERS), base)
+
     logger.info(f"Backup saved to {backup_file}")
-    
-    # Create a summary
-    summary = {name: len(data['tracks']) for name, data in backup.items()}
-    logger.info("\nBackup Summary:")
-    for playlist, count in summary.items():
-        logger.info(f"{playlist}: {count} tracks")
+    logger.info(f"Backup Summary: {total} playlists, {unchanged} reused from the previous backup, "
+                f"{backup_file.stat().st_size / 1024:.0f} KiB")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
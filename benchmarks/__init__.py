@@ -0,0 +1 @@
+"""Benchmarks for the sync, database and analysis hot paths."""
@@ -0,0 +1,83 @@
+"""Benchmark SpotifyAnalyzer.analyze_songs on synthetic libraries.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_analyze
+
+Each row doubles the number of memberships at a fixed library size. Once the
+fixed cost of allocating the song x playlist matrix is amortised, the time
+per membership stays flat, i.e. the analysis scales linearly with them.
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from db import connect
+from read_from_spotify import SpotifyAnalyzer
+
+USER_ID = 'bench-user'
+
+
+class _OfflineClient:
+    """Stand-in client, analyze_songs is only given an explicit user id."""
+
+
+def build_library(db_path: Path, songs: int, playlists: int, memberships: int, seed: int = 0):
+    """Fill a fresh cache database with a random library."""
+    rng = random.Random(seed)
+    analyzer = SpotifyAnalyzer(spotify_client=_OfflineClient(), db_path=db_path)
+    with connect(analyzer.db_path) as conn:
+        conn.executemany(
+            "INSERT INTO liked_songs (id, name, artist, added_at) VALUES (?, ?, ?, ?)",
+            ((f'song{i}', f'Song {i}', f'Artist {i % 500}', f'2024-01-01T00:00:{i:08d}Z')
+             for i in range(songs))
+        )
+        conn.executemany(
+            "INSERT INTO playlists (id, name, owner_id) VALUES (?, ?, ?)",
+            ((f'playlist{i}', f'Playlist {i}', USER_ID) for i in range(playlists))
+        )
+        pairs = set()
+        while len(pairs) < memberships:
+            pairs.add((f'playlist{rng.randrange(playlists)}', f'song{rng.randrange(songs)}'))
+        conn.executemany(
+            "INSERT INTO playlist_songs (playlist_id, song_id) VALUES (?, ?)", pairs
+        )
+    return analyzer
+
+
+def run(songs: int, playlists: int, memberships: int, repeat: int) -> float:
+    """Return the best analyze_songs time in seconds for one library size."""
+    with tempfile.TemporaryDirectory() as tmp:
+        analyzer = build_library(Path(tmp) / 'bench.db', songs, playlists, memberships)
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            analyzer.analyze_songs(user_id=USER_ID)
+            best = min(best, time.perf_counter() - start)
+        return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=20000)
+    parser.add_argument('--playlists', type=int, default=150)
+    parser.add_argument('--start', type=int, default=10000, help='memberships in the first run')
+    parser.add_argument('--steps', type=int, default=6, help='number of doublings')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'songs':>8} {'playlists':>10} {'memberships':>12} {'seconds':>9} {'us/membership':>14}")
+    memberships = args.start
+    for _ in range(args.steps):
+        memberships = min(memberships, args.songs * args.playlists)
+        seconds = run(args.songs, args.playlists, memberships, args.repeat)
+        print(f"{args.songs:>8} {args.playlists:>10} {memberships:>12} "
+              f"{seconds:>9.3f} {seconds / memberships * 1e6:>14.2f}")
+        memberships *= 2
+
+
+if __name__ == '__main__':
+    main()
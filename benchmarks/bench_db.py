@@ -0,0 +1,104 @@
+"""Benchmark per-request SQLite overhead of the web app's Database helper.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_db
+
+Each request runs the queries behind one page of ``/api/songs``: the data
+version its ETag is built from and the page of songs joined with their
+play stats. The baseline is the app's old helper, a plain
+``sqlite3.connect`` per request that re-prepares every statement; the pool
+reuses connections and their statement cache.
+"""
+
+import argparse
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+from db import ConnectionPool, connect, get_data_version, init_schema
+
+PAGE_SIZE = 200
+
+
+def build_library(db_path: Path, songs: int, plays: int):
+    """Fill a fresh cache database with songs and play history."""
+    init_schema(db_path)
+    with connect(db_path) as conn:
+        conn.executemany(
+            "INSERT INTO liked_songs (id, name, artist, added_at) VALUES (?, ?, ?, ?)",
+            ((f'song{i}', f'Song {i}', f'Artist {i % 500}', f'2024-01-01T00:00:{i:08d}Z')
+             for i in range(songs))
+        )
+        conn.executemany(
+            "INSERT INTO played_history (song_id, played_at) VALUES (?, ?)",
+            ((f'song{i * 7 % songs}', f'2024-02-01T00:00:{i:08d}Z') for i in range(plays))
+        )
+
+
+def song_page(conn: sqlite3.Connection, cursor):
+    """The queries of one /api/songs request."""
+    get_data_version(conn)
+    conn.execute("""
+        SELECT s.id, s.name, s.artist, s.added_at AS sort_key,
+               COALESCE(ps.play_count, 0) AS play_count, ps.last_played_at
+        FROM liked_songs s
+        LEFT JOIN play_stats ps ON ps.song_id = s.id
+        WHERE (s.added_at, s.id) < (?, ?)
+        ORDER BY sort_key DESC, s.id DESC
+        LIMIT ?
+    """, (*cursor, PAGE_SIZE)).fetchall()
+
+
+def per_request(db_path: Path, cursor):
+    # Database.__enter__ before the pool
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        song_page(conn, cursor)
+    finally:
+        conn.close()
+
+
+def run(db_path: Path, requests: int):
+    """Return mean seconds per request without and with the pool."""
+    cursor = ('9999', '')
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        per_request(db_path, cursor)
+    baseline = (time.perf_counter() - start) / requests
+
+    pool = ConnectionPool(db_path)
+    try:
+        start = time.perf_counter()
+        for _ in range(requests):
+            with pool.connection() as conn:
+                song_page(conn, cursor)
+        pooled = (time.perf_counter() - start) / requests
+    finally:
+        pool.close()
+    return baseline, pooled
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=20000)
+    parser.add_argument('--plays', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / 'bench.db'
+        build_library(db_path, args.songs, args.plays)
+        baseline, pooled = run(db_path, args.requests)
+
+    print(f"{'mode':>12} {'us/request':>11}")
+    print(f"{'connect':>12} {baseline * 1e6:>11.1f}")
+    print(f"{'pooled':>12} {pooled * 1e6:>11.1f}")
+    print(f"speedup {baseline / pooled:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
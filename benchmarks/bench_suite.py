@@ -0,0 +1,241 @@
+"""End-to-end performance benchmarks against a local fake Spotify API.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_suite
+    python -m benchmarks.bench_suite --sizes 100000:500 --latency 0.03
+
+For every ``songs:playlists`` size a synthetic library is served by
+``benchmarks.fake_spotify`` and synced into a fresh cache database. The
+suite reports the time and API calls of a full and an incremental refresh,
+the analysis time, and the time to render the main page and a page of
+``/api/songs`` through the Flask app. Peak Python memory is measured in a
+separate traced refresh, so tracing does not slow down the timed runs.
+
+The app part needs an ``envvars.py`` to import ``app`` and is skipped
+without one.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+from benchmarks.fake_spotify import FakeSpotifyServer, SyntheticLibrary
+from db import init_schema
+from read_from_spotify import SpotifyAnalyzer
+from spotify_clients import create_session
+
+DEFAULT_SIZES = '1000:10,10000:100'
+
+
+def parse_sizes(value: str) -> List[Tuple[int, int]]:
+    sizes = []
+    for size in value.split(','):
+        songs, playlists = size.split(':')
+        sizes.append((int(songs), int(playlists)))
+    return sizes
+
+
+@contextlib.contextmanager
+def quiet(verbose: bool):
+    """Hide the sync's progress output unless asked for."""
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+def timed(fn: Callable, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def refresh(server: FakeSpotifyServer, max_workers: int, full_resync: bool) -> SpotifyAnalyzer:
+    """Run the same steps as the app's refresh job."""
+    analyzer = SpotifyAnalyzer(
+        spotify_client=server.client(requests_session=create_session()),
+        max_workers=max_workers
+    )
+    analyzer.fetch_all_liked_songs(full_resync=full_resync)
+    analyzer.fetch_all_playlists(full_resync=full_resync)
+    return analyzer
+
+
+def bench_refresh(server: FakeSpotifyServer, max_workers: int, verbose: bool) -> Dict[str, float]:
+    results = {}
+    for name, full_resync in (('full', True), ('incremental', False)):
+        server.reset_calls()
+        with quiet(verbose):
+            results[f'{name}_refresh_s'] = timed(refresh, server, max_workers, full_resync)
+        results[f'{name}_refresh_calls'] = sum(server.calls.values())
+
+    analyzer = SpotifyAnalyzer(spotify_client=server.client(), max_workers=max_workers)
+    with quiet(verbose):
+        results['analyze_s'] = timed(analyzer.analyze_songs, server.library.user_id)
+    return results
+
+
+def bench_memory(server: FakeSpotifyServer, max_workers: int, verbose: bool) -> Dict[str, float]:
+    """Peak traced memory of a full refresh into an empty database."""
+    tracemalloc.start()
+    try:
+        with quiet(verbose):
+            refresh(server, max_workers, full_resync=True)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'refresh_peak_mib': peak / 2 ** 20}
+
+
+def load_app():
+    """Import the Flask app, or return None when it cannot be configured.
+
+    Importing creates the app's database in the working directory, so this
+    happens in a scratch directory.
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            import app
+        except ImportError as e:
+            print(f"Skipping page benchmarks, cannot import app: {e}")
+            return None
+        finally:
+            os.chdir(cwd)
+    return app
+
+
+def bench_pages(app_module, server: FakeSpotifyServer, requests: int) -> Dict[str, float]:
+    """Time page renders and API requests through the Flask test client."""
+    from db import ConnectionPool
+
+    # Point the app's globals at this run's database and server
+    app_module.db_pool.close()
+    app_module.db_pool = ConnectionPool()
+    app_module.membership_index.invalidate()
+    app_module.catalogue_cache.invalidate()
+    app_module.spotify_clients.api_prefix = server.api_prefix
+    app_module.spotify_clients._clients.clear()
+
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['token_info'] = {
+            'access_token': 'fake-token',
+            'token_type': 'Bearer',
+            'refresh_token': 'fake-refresh-token',
+            'scope': app_module.SCOPE,
+            'expires_in': 3600,
+            'expires_at': int(time.time()) + 3600
+        }
+
+    def get(path: str) -> float:
+        start = time.perf_counter()
+        response = client.get(path)
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {path} returned {response.status_code}")
+        return elapsed
+
+    results = {}
+    server.reset_calls()
+    results['index_cold_ms'] = get('/') * 1000
+    results['index_cold_calls'] = sum(server.calls.values())
+    results['index_warm_ms'] = min(get('/') for _ in range(requests)) * 1000
+    results['songs_first_ms'] = get('/api/songs') * 1000
+
+    cursor = client.get('/api/songs').json['next_cursor']
+    if cursor:
+        results['songs_next_ms'] = min(get(f'/api/songs?cursor={cursor}') for _ in range(requests)) * 1000
+
+    playlist = next(p for p in server.library.playlists if p['owner'] == server.library.user_id)
+    song_id = next(iter(server.library.tracks))
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        client.post('/api/toggle_playlist', json={'song_id': song_id, 'playlist_id': playlist['id']})
+        timings.append(time.perf_counter() - start)
+    results['toggle_ms'] = min(timings) * 1000
+    app_module.write_queue.drain(timeout=60)
+    return results
+
+
+def run_size(songs: int, playlists: int, args, app_module) -> Dict[str, float]:
+    library = SyntheticLibrary(songs=songs, playlists=playlists, seed=args.seed)
+    results = {'memberships': library.memberships}
+    cwd = os.getcwd()
+    with FakeSpotifyServer(library, latency=args.latency, rate_limit_every=args.rate_limit_every,
+                           retry_after=args.retry_after) as server:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                init_schema()
+                results.update(bench_refresh(server, args.max_workers, args.verbose))
+                if app_module is not None:
+                    results.update(bench_pages(app_module, server, args.requests))
+            finally:
+                os.chdir(cwd)
+
+        if not args.no_memory:
+            with tempfile.TemporaryDirectory() as tmp:
+                os.chdir(tmp)
+                try:
+                    init_schema()
+                    results.update(bench_memory(server, args.max_workers, args.verbose))
+                finally:
+                    os.chdir(cwd)
+    return results
+
+
+def print_results(results: Dict[Tuple[int, int], Dict[str, float]]):
+    columns = list(dict.fromkeys(key for row in results.values() for key in row))
+    sizes = [f'{songs}:{playlists}' for songs, playlists in results]
+    width = max(len(column) for column in columns)
+    print(f"{'':<{width}} " + ' '.join(f'{size:>14}' for size in sizes))
+    for column in columns:
+        values = []
+        for row in results.values():
+            value: Optional[float] = row.get(column)
+            if value is None:
+                values.append(f"{'-':>14}")
+            elif isinstance(value, int):
+                values.append(f'{value:>14d}')
+            else:
+                values.append(f'{value:>14.3f}')
+        print(f'{column:<{width}} ' + ' '.join(values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=parse_sizes, default=parse_sizes(DEFAULT_SIZES),
+                        help=f'comma separated songs:playlists, default {DEFAULT_SIZES}')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every API call')
+    parser.add_argument('--rate-limit-every', type=int, default=0,
+                        help='answer every n-th API call with 429')
+    parser.add_argument('--retry-after', type=int, default=0, help='Retry-After of rate limited calls')
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=20, help='repeats of each timed app request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-app', action='store_true', help='skip the page benchmarks')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced refresh')
+    parser.add_argument('--verbose', action='store_true', help='show the sync output')
+    args = parser.parse_args()
+
+    app_module = None if args.no_app else load_app()
+    results = {}
+    for songs, playlists in args.sizes:
+        print(f"Benchmarking {songs} songs in {playlists} playlists...")
+        results[(songs, playlists)] = run_size(songs, playlists, args, app_module)
+    print()
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
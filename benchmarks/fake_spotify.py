@@ -0,0 +1,387 @@
+"""Local stand-in for the parts of the Spotify Web API this app uses.
+
+The server keeps a synthetic library in memory and answers the endpoints
+spotipy calls for syncing, playlist edits, likes and playback. Latency,
+page sizes and rate limiting are configurable, and every request is
+counted, so benchmarks can run the real code paths without an account:
+
+    library = SyntheticLibrary(songs=10000, playlists=100)
+    with FakeSpotifyServer(library, latency=0.02) as server:
+        sp = server.client()
+        sp.current_user_saved_tracks(limit=50)
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import spotipy
+
+USER_ID = 'bench-user'
+OTHER_USER_ID = 'someone-else'
+
+
+class SyntheticLibrary:
+    """A random but reproducible Spotify library.
+
+    ``songs`` liked tracks, newest first, and ``playlists`` playlists of on
+    average ``playlist_size`` liked tracks each. A ``followed_fraction`` of
+    the playlists belongs to another user.
+    """
+
+    def __init__(self, songs: int = 1000, playlists: int = 10, playlist_size: int = 100,
+                 followed_fraction: float = 0.1, seed: int = 0):
+        rng = random.Random(seed)
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+        self.user_id = USER_ID
+        self.tracks: Dict[str, Dict] = {}
+        self.saved: List[Dict] = []
+        for i in range(songs):
+            track_id = f'{i:022d}'
+            self.tracks[track_id] = {
+                'id': track_id,
+                'name': f'Song {i}',
+                'uri': f'spotify:track:{track_id}',
+                'duration_ms': 180000 + i % 120000,
+                'artists': [{'name': f'Artist {i % max(1, songs // 20)}'}]
+            }
+            added_at = start - timedelta(minutes=i)
+            self.saved.append({
+                'added_at': added_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'track_id': track_id
+            })
+
+        track_ids = list(self.tracks)
+        self.playlists: List[Dict] = []
+        for i in range(playlists):
+            size = min(len(track_ids), max(1, int(rng.expovariate(1 / playlist_size)))) if track_ids else 0
+            owner = OTHER_USER_ID if rng.random() < followed_fraction else self.user_id
+            self.playlists.append({
+                'id': f'playlist{i:014d}',
+                'name': f'Playlist {i}',
+                'owner': owner,
+                'version': 1,
+                'track_ids': rng.sample(track_ids, size)
+            })
+
+    @property
+    def memberships(self) -> int:
+        return sum(len(playlist['track_ids']) for playlist in self.playlists)
+
+    def playlist(self, playlist_id: str) -> Optional[Dict]:
+        for playlist in self.playlists:
+            if playlist['id'] == playlist_id:
+                return playlist
+        return None
+
+
+def _snapshot(playlist: Dict) -> str:
+    return f"{playlist['id']}-{playlist['version']}"
+
+
+def _track_id(uri: str) -> str:
+    return uri.rsplit(':', 1)[-1]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: 'FakeSpotifyServer'
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = [
+        ('GET', r'/v1/me', 'me'),
+        ('GET', r'/v1/me/tracks', 'saved_tracks'),
+        ('PUT', r'/v1/me/tracks', 'save_tracks'),
+        ('DELETE', r'/v1/me/tracks', 'unsave_tracks'),
+        ('GET', r'/v1/me/playlists', 'playlists'),
+        ('GET', r'/v1/playlists/(?P<playlist_id>[^/]+)/tracks', 'playlist_tracks'),
+        ('POST', r'/v1/playlists/(?P<playlist_id>[^/]+)/tracks', 'add_tracks'),
+        ('DELETE', r'/v1/playlists/(?P<playlist_id>[^/]+)/tracks', 'remove_tracks'),
+        ('PUT', r'/v1/playlists/(?P<playlist_id>[^/]+)/tracks', 'replace_or_reorder'),
+        ('GET', r'/v1/me/player', 'playback'),
+        ('GET', r'/v1/me/player/devices', 'devices'),
+        ('PUT', r'/v1/me/player/play', 'play'),
+        ('PUT', r'/v1/me/player/pause', 'pause'),
+        ('PUT', r'/v1/me/player/seek', 'seek'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method: str):
+        url = urlparse(self.path)
+        path = url.path.rstrip('/')
+        self.query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = json.loads(self.rfile.read(length) or b'null') if length else None
+
+        for route_method, pattern, name in self.ROUTES:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            self._send(404, {'error': {'status': 404, 'message': f'No route for {method} {path}'}})
+            return
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.should_rate_limit(name):
+            self._send(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                       {'Retry-After': str(self.server.retry_after)})
+            return
+
+        with self.server.lock:
+            status, body = getattr(self, f'_{name}')(**match.groupdict())
+        self._send(status, body)
+
+    def _send(self, status: int, body, headers: Optional[Dict[str, str]] = None):
+        data = b'' if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _page(self, items: List, max_limit: int):
+        limit = min(int(self.query.get('limit', 20)), max_limit)
+        offset = int(self.query.get('offset', 0))
+        next_url = None
+        if offset + limit < len(items):
+            endpoint = urlparse(self.path).path[len('/v1/'):]
+            next_url = f'{self.server.api_prefix}{endpoint}?offset={offset + limit}&limit={limit}'
+        return {
+            'items': items[offset:offset + limit],
+            'total': len(items),
+            'limit': limit,
+            'offset': offset,
+            'next': next_url
+        }
+
+    def _track(self, track_id: str) -> Dict:
+        return self.server.library.tracks.get(track_id) or {
+            'id': track_id, 'name': track_id, 'uri': f'spotify:track:{track_id}',
+            'duration_ms': 200000, 'artists': []
+        }
+
+    def _playlist_or_404(self, playlist_id: str):
+        playlist = self.server.library.playlist(playlist_id)
+        if playlist is None:
+            return None, (404, {'error': {'status': 404, 'message': 'Playlist not found'}})
+        return playlist, None
+
+    # Endpoints
+
+    def _me(self):
+        return 200, {'id': self.server.library.user_id}
+
+    def _saved_tracks(self):
+        library = self.server.library
+        start = int(self.query.get('offset', 0))
+        end = start + min(int(self.query.get('limit', 20)), 50)
+        page = self._page(library.saved, 50)
+        page['items'] = [
+            {'added_at': item['added_at'], 'track': self._track(item['track_id'])}
+            for item in library.saved[start:end]
+        ]
+        return 200, page
+
+    def _save_tracks(self):
+        library = self.server.library
+        saved = {item['track_id'] for item in library.saved}
+        added_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        for track_id in self.query.get('ids', '').split(','):
+            if track_id and track_id not in saved:
+                library.saved.insert(0, {'added_at': added_at, 'track_id': track_id})
+        return 200, None
+
+    def _unsave_tracks(self):
+        library = self.server.library
+        removed = set(self.query.get('ids', '').split(','))
+        library.saved = [item for item in library.saved if item['track_id'] not in removed]
+        return 200, None
+
+    def _playlists(self):
+        items = [{
+            'id': playlist['id'],
+            'name': playlist['name'],
+            'owner': {'id': playlist['owner']},
+            'snapshot_id': _snapshot(playlist),
+            'tracks': {'total': len(playlist['track_ids'])}
+        } for playlist in self.server.library.playlists]
+        return 200, self._page(items, 50)
+
+    def _playlist_tracks(self, playlist_id):
+        playlist, error = self._playlist_or_404(playlist_id)
+        if error:
+            return error
+        start = int(self.query.get('offset', 0))
+        end = start + min(int(self.query.get('limit', 100)), 100)
+        page = self._page(playlist['track_ids'], 100)
+        page['items'] = [
+            {'added_at': '2024-01-01T00:00:00Z', 'track': self._track(track_id)}
+            for track_id in playlist['track_ids'][start:end]
+        ]
+        return 200, page
+
+    def _add_tracks(self, playlist_id):
+        playlist, error = self._playlist_or_404(playlist_id)
+        if error:
+            return error
+        # spotipy sends the uris as the body and the position as a parameter
+        uris = self.body['uris'] if isinstance(self.body, dict) else self.body
+        track_ids = [_track_id(uri) for uri in uris]
+        position = self.query.get('position')
+        if position is not None:
+            position = int(position)
+        if position is None:
+            playlist['track_ids'].extend(track_ids)
+        else:
+            playlist['track_ids'][position:position] = track_ids
+        playlist['version'] += 1
+        return 201, {'snapshot_id': _snapshot(playlist)}
+
+    def _remove_tracks(self, playlist_id):
+        playlist, error = self._playlist_or_404(playlist_id)
+        if error:
+            return error
+        removed = {_track_id(track['uri']) for track in self.body['tracks']}
+        playlist['track_ids'] = [track_id for track_id in playlist['track_ids'] if track_id not in removed]
+        playlist['version'] += 1
+        return 200, {'snapshot_id': _snapshot(playlist)}
+
+    def _replace_or_reorder(self, playlist_id):
+        playlist, error = self._playlist_or_404(playlist_id)
+        if error:
+            return error
+        body = self.body or {}
+        if 'range_start' in body:
+            start, length = body['range_start'], body.get('range_length', 1)
+            insert_before = body['insert_before']
+            block = playlist['track_ids'][start:start + length]
+            del playlist['track_ids'][start:start + length]
+            if insert_before > start:
+                insert_before -= length
+            playlist['track_ids'][insert_before:insert_before] = block
+        else:
+            playlist['track_ids'] = [_track_id(uri) for uri in body.get('uris', [])]
+        playlist['version'] += 1
+        return 200, {'snapshot_id': _snapshot(playlist)}
+
+    def _playback(self):
+        player = self.server.player
+        if player['track_id'] is None:
+            return 204, None
+        progress = player['progress_ms']
+        if player['is_playing']:
+            progress += int((time.monotonic() - player['since']) * 1000)
+        track = self._track(player['track_id'])
+        return 200, {
+            'is_playing': player['is_playing'],
+            'progress_ms': min(progress, track['duration_ms']),
+            'item': track,
+            'device': {'id': 'fake-device', 'is_active': True}
+        }
+
+    def _devices(self):
+        return 200, {'devices': [{'id': 'fake-device', 'is_active': True, 'name': 'Benchmark'}]}
+
+    def _play(self):
+        self.server.player.update(
+            track_id=_track_id(self.body['uris'][0]), is_playing=True,
+            progress_ms=0, since=time.monotonic()
+        )
+        return 204, None
+
+    def _pause(self):
+        player = self.server.player
+        if not player['is_playing']:
+            return 403, {'error': {'status': 403, 'message': 'Player command failed: Restriction violated'}}
+        player['progress_ms'] += int((time.monotonic() - player['since']) * 1000)
+        player['is_playing'] = False
+        return 204, None
+
+    def _seek(self):
+        player = self.server.player
+        player.update(progress_ms=int(self.query['position_ms']), since=time.monotonic())
+        return 204, None
+
+
+class FakeSpotifyServer(ThreadingHTTPServer):
+    """Serve a ``SyntheticLibrary`` on a local port.
+
+    ``latency`` seconds are added to every request. With ``rate_limit_every``
+    set, every n-th request is answered with 429 and ``retry_after``.
+    ``calls`` counts requests per endpoint, including rate limited ones.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, library: SyntheticLibrary, latency: float = 0.0,
+                 rate_limit_every: int = 0, retry_after: int = 1):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.library = library
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.player = {'track_id': None, 'is_playing': False, 'progress_ms': 0, 'since': 0.0}
+        self._requests = 0
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def api_prefix(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1/'
+
+    def should_rate_limit(self, endpoint: str) -> bool:
+        with self.lock:
+            self.calls[endpoint] += 1
+            self._requests += 1
+            return bool(self.rate_limit_every) and self._requests % self.rate_limit_every == 0
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    def client(self, **kwargs) -> spotipy.Spotify:
+        """A spotipy client that talks to this server."""
+        sp = spotipy.Spotify(auth='fake-token', **kwargs)
+        sp.prefix = self.api_prefix
+        return sp
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-spotify', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
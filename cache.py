@@ -0,0 +1,56 @@
+"""Small in-process cache for data that is expensive to fetch from Spotify."""
+
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class TTLCache:
+    """Thread-safe key-value cache whose entries expire after ``ttl`` seconds.
+
+    ``get_or_load`` lets one caller load a missing entry while concurrent
+    callers for the same cache wait for it instead of loading it again.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value, or ``default`` if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Return the cached value, calling ``loader`` to fill a miss."""
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        with self._load_lock:
+            value = self.get(key, missing)
+            if value is missing:
+                value = loader()
+                self.set(key, value)
+            return value
+
+    def invalidate(self, key: Hashable = None):
+        """Drop one entry, or every entry when no key is given."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
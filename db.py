@@ -0,0 +1,442 @@
+"""SQLite connection setup and batched writes for the local cache."""
+
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterable, List, Optional, Sequence
+
+from metrics import observe_sqlite
+
+DB_PATH = Path("spotify_cache.db")
+
+# WAL lets the web app keep reading while a sync is writing. NORMAL
+# synchronous is safe in WAL mode and avoids an fsync per commit.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+)
+
+# Seconds a connection waits for a lock before raising "database is locked"
+BUSY_TIMEOUT = 5.0
+
+
+def _operation(sql: str) -> str:
+    words = sql.split(None, 1)
+    return words[0].upper() if words else ''
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection that records how long each statement takes to execute.
+
+    Rows fetched after ``execute`` returns are not included, which for most
+    queries here is a small part of the work.
+    """
+
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            observe_sqlite(_operation(sql), time.perf_counter() - start)
+
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            observe_sqlite(_operation(sql), time.perf_counter() - start)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            observe_sqlite('COMMIT', time.perf_counter() - start)
+
+
+def connect(db_path=DB_PATH, **kwargs) -> sqlite3.Connection:
+    """Open a connection to the cache database with the tuned pragmas."""
+    kwargs.setdefault('factory', TimedConnection)
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, **kwargs)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _create_tables(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS liked_songs (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            artist TEXT,
+            added_at TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS playlists (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            owner_id TEXT,
+            snapshot_id TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS playlist_songs (
+            playlist_id TEXT,
+            song_id TEXT,
+            FOREIGN KEY(playlist_id) REFERENCES playlists(id),
+            FOREIGN KEY(song_id) REFERENCES liked_songs(id),
+            PRIMARY KEY(playlist_id, song_id)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS played_history (
+            song_id TEXT,
+            played_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(song_id) REFERENCES liked_songs(id),
+            PRIMARY KEY(song_id, played_at)
+        )
+    """)
+
+    # Databases created before snapshot tracking lack the column
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(playlists)")}
+    if 'snapshot_id' not in columns:
+        conn.execute("ALTER TABLE playlists ADD COLUMN snapshot_id TEXT")
+
+
+def _add_lookup_indexes(conn: sqlite3.Connection):
+    # Keyset pagination of the song grid walks this index
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_liked_songs_added_at
+            ON liked_songs(added_at, id)
+    """)
+    # The primary key only serves lookups by playlist
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_playlist_songs_song
+            ON playlist_songs(song_id, playlist_id)
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_playlists_owner
+            ON playlists(owner_id)
+    """)
+    conn.execute("ANALYZE")
+
+
+def _add_meta(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    # Libraries synced before this was tracked are taken to be complete
+    conn.execute("""
+        INSERT OR IGNORE INTO meta (key, value)
+        SELECT 'liked_songs_complete', '1'
+        WHERE EXISTS (SELECT 1 FROM liked_songs)
+    """)
+
+
+def _add_song_search(conn: sqlite3.Connection):
+    # Full-text index over the liked songs' names and artists. It reads the
+    # text from liked_songs, so it only stores the index; triggers keep it in
+    # step with every write to the table.
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS liked_songs_fts USING fts5(
+            name, artist,
+            content='liked_songs', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='1 2 3'
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS liked_songs_fts_insert AFTER INSERT ON liked_songs BEGIN
+            INSERT INTO liked_songs_fts (rowid, name, artist) VALUES (new.rowid, new.name, new.artist);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS liked_songs_fts_delete AFTER DELETE ON liked_songs BEGIN
+            INSERT INTO liked_songs_fts (liked_songs_fts, rowid, name, artist)
+            VALUES ('delete', old.rowid, old.name, old.artist);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS liked_songs_fts_update AFTER UPDATE OF name, artist ON liked_songs BEGIN
+            INSERT INTO liked_songs_fts (liked_songs_fts, rowid, name, artist)
+            VALUES ('delete', old.rowid, old.name, old.artist);
+            INSERT INTO liked_songs_fts (rowid, name, artist) VALUES (new.rowid, new.name, new.artist);
+        END
+    """)
+    conn.execute("INSERT INTO liked_songs_fts (liked_songs_fts) VALUES ('rebuild')")
+
+
+def _add_play_stats(conn: sqlite3.Connection):
+    # One row per played song, so reading play counts does not grow with
+    # the listening history. The trigger updates it in the transaction that
+    # records the play.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS play_stats (
+            song_id TEXT PRIMARY KEY,
+            play_count INTEGER NOT NULL,
+            first_played_at TIMESTAMP,
+            last_played_at TIMESTAMP
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS played_history_stats AFTER INSERT ON played_history BEGIN
+            INSERT INTO play_stats (song_id, play_count, first_played_at, last_played_at)
+            VALUES (new.song_id, 1, new.played_at, new.played_at)
+            ON CONFLICT(song_id) DO UPDATE SET
+                play_count = play_count + 1,
+                first_played_at = MIN(first_played_at, excluded.first_played_at),
+                last_played_at = MAX(last_played_at, excluded.last_played_at);
+        END
+    """)
+    conn.execute("""
+        INSERT OR REPLACE INTO play_stats (song_id, play_count, first_played_at, last_played_at)
+        SELECT song_id, COUNT(*), MIN(played_at), MAX(played_at)
+        FROM played_history
+        GROUP BY song_id
+    """)
+
+
+def _add_data_version(conn: sqlite3.Connection):
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('data_version', '0')")
+
+
+def _reset_playlist_snapshots(conn: sqlite3.Connection):
+    # Syncs used to delete the memberships of unliked songs, which the
+    # snapshot skip then never refetched; the next sync rebuilds them all
+    conn.execute("UPDATE playlists SET snapshot_id = NULL")
+
+
+# Schema migrations in order. A database whose user_version is N has had
+# the first N applied; existing tables from before versioning are adopted
+# by the first one.
+MIGRATIONS = (
+    _create_tables,
+    _add_lookup_indexes,
+    _add_meta,
+    _add_song_search,
+    _add_play_stats,
+    _add_data_version,
+    _reset_playlist_snapshots,
+)
+
+
+def init_schema(db_path=DB_PATH):
+    """Create the schema or upgrade it to the latest version."""
+    conn = connect(db_path)
+    try:
+        while True:
+            # The write lock keeps concurrent processes from migrating twice
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    conn.rollback()
+                    return
+                MIGRATIONS[version](conn)
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        conn.close()
+
+
+def get_meta(conn: sqlite3.Connection, key: str, default: Optional[str] = None) -> Optional[str]:
+    """Read a value from the meta table."""
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return default if row is None else row[0]
+
+
+SET_META = "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)"
+
+# Run in the transaction of every write the UI can see. The app uses the
+# version to answer repeated reads with 304 Not Modified.
+BUMP_DATA_VERSION = "UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'data_version'"
+
+
+def get_data_version(conn: sqlite3.Connection) -> int:
+    """Read the counter bumped by ``BUMP_DATA_VERSION``."""
+    return int(get_meta(conn, 'data_version', 0))
+
+
+def fts_query(text: str) -> str:
+    """Turn search box input into an FTS5 query matching every word as a prefix.
+
+    Words are quoted, so characters with a meaning in the query syntax are
+    searched for literally.
+    """
+    words = text.split()
+    return ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+
+
+class ConnectionPool:
+    """Reuse open connections instead of connecting on every request.
+
+    A connection is used by one thread at a time and then returned, so it
+    keeps its pragmas and prepared-statement cache across requests. The
+    development server starts a thread per request, which is why connections
+    are pooled rather than bound to threads.
+    """
+
+    def __init__(self, db_path=DB_PATH, max_idle: int = 8, cached_statements: int = 256):
+        self.db_path = db_path
+        self.max_idle = max_idle
+        self.cached_statements = cached_statements
+        self._idle: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> sqlite3.Connection:
+        """Take an idle connection or open a new one."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        conn = connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        """Return a connection, discarding any uncommitted changes."""
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+# Insert a liked song or update it only when something changed. Unlike
+# INSERT OR REPLACE this keeps the row, so the search index triggers only
+# fire for real changes.
+UPSERT_LIKED_SONG = """
+    INSERT INTO liked_songs (id, name, artist, added_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        name = excluded.name,
+        artist = excluded.artist,
+        added_at = excluded.added_at
+    WHERE name IS NOT excluded.name OR artist IS NOT excluded.artist
+        OR added_at IS NOT excluded.added_at
+"""
+
+
+# Insert a playlist or update it only when its name or owner changed, so an
+# unchanged catalogue costs no writes
+UPSERT_PLAYLIST = """
+    INSERT INTO playlists (id, name, owner_id)
+    VALUES (?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        name = excluded.name,
+        owner_id = excluded.owner_id
+    WHERE name IS NOT excluded.name OR owner_id IS NOT excluded.owner_id
+"""
+
+
+class BatchWriter:
+    """Buffer writes and flush them with executemany in short transactions.
+
+    Statements are written in the order they were added. No transaction is
+    kept open between flushes, so readers are never blocked while the caller
+    waits on the network. Closing a writer that wrote anything bumps the
+    data version, also when it is closed by an error.
+    """
+
+    def __init__(self, db_path=DB_PATH, batch_size: int = 500):
+        self.conn = connect(db_path)
+        self.batch_size = batch_size
+        self._batches: List[List[Any]] = []
+        self._pending = 0
+        self._group_depth = 0
+        self._wrote = False
+
+    def execute(self, sql: str, params: Sequence = ()):
+        """Queue a single statement."""
+        self._add(sql, [params])
+
+    def executemany(self, sql: str, rows: Iterable[Sequence]):
+        """Queue a statement for every row."""
+        self._add(sql, list(rows))
+
+    def _add(self, sql: str, rows: List[Sequence]):
+        if not rows:
+            return
+        if self._batches and self._batches[-1][0] == sql:
+            self._batches[-1][1].extend(rows)
+        else:
+            self._batches.append([sql, rows])
+        self._pending += len(rows)
+        if self._group_depth == 0 and self._pending >= self.batch_size:
+            self.flush()
+
+    @contextmanager
+    def group(self):
+        """Keep the statements queued inside the block in the same transaction."""
+        self._group_depth += 1
+        try:
+            yield self
+        finally:
+            self._group_depth -= 1
+        if self._group_depth == 0 and self._pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write all queued statements in one transaction."""
+        if not self._batches:
+            return
+        with self.conn:
+            for sql, rows in self._batches:
+                self.conn.executemany(sql, rows)
+        self._batches = []
+        self._pending = 0
+        self._wrote = True
+
+    def close(self):
+        """Flush pending writes and close the connection."""
+        try:
+            self.flush()
+        finally:
+            try:
+                if self._wrote:
+                    with self.conn:
+                        self.conn.execute(BUMP_DATA_VERSION)
+            finally:
+                self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            # Keep what was already committed, drop the unfinished batch
+            self._batches = []
+            self._pending = 0
+        self.close()
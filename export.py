@@ -0,0 +1,188 @@
+"""Stream the song x playlist membership matrix from the cache database."""
+
+import argparse
+import csv
+import io
+import json
+import logging
+import sqlite3
+import sys
+from contextlib import contextmanager
+from itertools import groupby
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from db import DB_PATH, connect, get_meta
+
+logger = logging.getLogger(__name__)
+
+# Lines written per chunk; memory use depends on this, not on the library
+CHUNK_LINES = 1000
+
+# Media type and default file name per format
+FORMATS = {
+    'csv': ('text/csv', 'spotify_export.csv'),
+    'ndjson': ('application/x-ndjson', 'spotify_export.ndjson'),
+    'long': ('text/csv', 'spotify_memberships.csv'),
+}
+
+# Liked songs newest first, each followed by its owned playlists. The order
+# matches idx_liked_songs_added_at scanned backwards, so SQLite streams the
+# rows without sorting them, and memberships come from idx_playlist_songs_song.
+_MEMBERSHIP_ROWS = """
+    SELECT s.id, s.name, s.artist, s.added_at, ps.playlist_id
+    FROM liked_songs s
+    LEFT JOIN playlist_songs ps
+        ON ps.song_id = s.id
+        AND ps.playlist_id IN (SELECT id FROM playlists WHERE owner_id = ?)
+    ORDER BY s.added_at DESC, s.id DESC
+"""
+
+Song = Tuple[str, str, str, str]
+
+
+def owned_playlists(conn: sqlite3.Connection, user_id: str) -> List[Tuple[str, str]]:
+    """Ids and names of the user's playlists, sorted by id like analyze_songs."""
+    return conn.execute(
+        "SELECT id, name FROM playlists WHERE owner_id = ? ORDER BY id", (user_id,)
+    ).fetchall()
+
+
+def iter_songs(conn: sqlite3.Connection, user_id: str) -> Iterator[Tuple[Song, List[str]]]:
+    """Yield every liked song with the ids of the owned playlists it is in."""
+    rows = conn.execute(_MEMBERSHIP_ROWS, (user_id,))
+    for _, group in groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+        song = group[0][:4]
+        yield song, [row[4] for row in group if row[4] is not None]
+
+
+def _chunks(lines: Iterator[str]) -> Iterator[str]:
+    """Join lines into chunks, the first line on its own so it is sent at once."""
+    buffer = []
+    first = True
+    for line in lines:
+        buffer.append(line)
+        if first or len(buffer) >= CHUNK_LINES:
+            yield ''.join(buffer)
+            buffer = []
+            first = False
+    if buffer:
+        yield ''.join(buffer)
+
+
+class _CsvLines:
+    """Format rows as CSV lines with a single reused writer."""
+
+    def __init__(self):
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+
+    def __call__(self, row) -> str:
+        self._writer.writerow(row)
+        line = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return line
+
+
+def _matrix_csv(conn: sqlite3.Connection, user_id: str) -> Iterator[str]:
+    csv_line = _CsvLines()
+    playlists = owned_playlists(conn, user_id)
+    playlist_ids = [playlist_id for playlist_id, _ in playlists]
+    yield csv_line(['id', 'name', 'artist', 'added_at'] + [name for _, name in playlists])
+    for song, memberships in iter_songs(conn, user_id):
+        memberships = set(memberships)
+        yield csv_line(list(song) + [int(playlist_id in memberships) for playlist_id in playlist_ids])
+
+
+def _ndjson(conn: sqlite3.Connection, user_id: str) -> Iterator[str]:
+    for playlist_id, name in owned_playlists(conn, user_id):
+        yield json.dumps({'type': 'playlist', 'id': playlist_id, 'name': name}) + '\n'
+    for (song_id, name, artist, added_at), memberships in iter_songs(conn, user_id):
+        yield json.dumps({
+            'type': 'song',
+            'id': song_id,
+            'name': name,
+            'artist': artist,
+            'added_at': added_at,
+            'playlists': memberships
+        }) + '\n'
+
+
+def _long_csv(conn: sqlite3.Connection, user_id: str) -> Iterator[str]:
+    csv_line = _CsvLines()
+    yield csv_line(['song_id', 'playlist_id'])
+    for song, memberships in iter_songs(conn, user_id):
+        for playlist_id in memberships:
+            yield csv_line([song[0], playlist_id])
+
+
+_WRITERS = {'csv': _matrix_csv, 'ndjson': _ndjson, 'long': _long_csv}
+
+
+def iter_export(conn: sqlite3.Connection, user_id: str, fmt: str = 'csv') -> Iterator[str]:
+    """Yield an export as text chunks of up to ``CHUNK_LINES`` lines.
+
+    ``csv`` is the matrix ``analyze_songs`` builds, one 0/1 column per owned
+    playlist headed by its name. ``ndjson`` lists the playlists, then one
+    song per line with the ids of its playlists. ``long`` has a
+    ``song_id,playlist_id`` row per membership. Everything is read in one
+    transaction, so the export is a consistent snapshot even while a sync
+    is writing.
+    """
+    if fmt not in _WRITERS:
+        raise ValueError(f"Unknown export format {fmt!r}, expected one of {', '.join(_WRITERS)}")
+    conn.execute("BEGIN")
+    try:
+        yield from _chunks(_WRITERS[fmt](conn, user_id))
+    finally:
+        conn.rollback()
+
+
+@contextmanager
+def export_connection(db_path=DB_PATH) -> Iterator[sqlite3.Connection]:
+    """A connection of its own, since an export reads for as long as the
+    client takes to download it."""
+    conn = connect(db_path)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def stored_user_id(conn: sqlite3.Connection) -> Optional[str]:
+    """The user of the last playlist sync."""
+    return get_meta(conn, 'user_id')
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--format', choices=list(FORMATS), default='csv')
+    parser.add_argument('--output', default=None,
+                        help="file to write, '-' for stdout, default spotify_export.csv, "
+                             "spotify_export.ndjson or spotify_memberships.csv")
+    parser.add_argument('--user-id', help='owner of the exported playlists, default the last synced user')
+    parser.add_argument('--db', type=Path, default=DB_PATH)
+    args = parser.parse_args()
+
+    with export_connection(args.db) as conn:
+        user_id = args.user_id or stored_user_id(conn)
+        if user_id is None:
+            parser.error("no synced user in the database, run a refresh first or pass --user-id")
+
+        if args.output == '-':
+            for chunk in iter_export(conn, user_id, args.format):
+                sys.stdout.write(chunk)
+            return
+
+        output = Path(args.output or FORMATS[args.format][1])
+        with open(output, 'w', encoding='utf-8', newline='') as f:
+            for chunk in iter_export(conn, user_id, args.format):
+                f.write(chunk)
+        logger.info(f"Exported {args.format} to {output}")
+
+
+if __name__ == '__main__':
+    main()
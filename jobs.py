@@ -0,0 +1,103 @@
+"""Background jobs for long running syncs."""
+
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from metrics import JOB_DURATION, JOB_RUNS
+from read_from_spotify import SyncCancelled, SyncProgress
+
+# Finished jobs kept for progress requests
+MAX_FINISHED_JOBS = 20
+
+
+class Job:
+    """One run of a background task and its progress."""
+
+    def __init__(self, key: str):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.progress = SyncProgress()
+        self.status = 'running'
+        self.error: Optional[str] = None
+        self.result: Any = None
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'result': self.result,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            **self.progress.snapshot()
+        }
+
+
+class JobRunner:
+    """Run tasks in background threads, at most one per key at a time.
+
+    Starting a task while one with the same key is running returns the
+    running job instead, so repeated triggers share one run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs: 'OrderedDict[str, Job]' = OrderedDict()
+        self._running: Dict[str, Job] = {}
+
+    def start(self, key: str, task: Callable[[SyncProgress], Any]) -> Tuple[Job, bool]:
+        """Start ``task(progress)`` unless a job for ``key`` is running.
+
+        Returns the job and whether it was newly started.
+        """
+        with self._lock:
+            job = self._running.get(key)
+            if job is not None:
+                return job, False
+            job = Job(key)
+            self._running[key] = job
+            self._jobs[job.id] = job
+            self._prune()
+
+        threading.Thread(target=self._run, args=(job, task), name=f'job-{key}', daemon=True).start()
+        return job, True
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """Ask a running job to stop at its next progress update."""
+        job = self.get(job_id)
+        if job is not None and job.status == 'running':
+            job.progress.cancel()
+        return job
+
+    def _run(self, job: Job, task: Callable[[SyncProgress], Any]):
+        try:
+            job.result = task(job.progress)
+            job.status = 'done'
+        except SyncCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            print(f"Error in job {job.key}: {e}")
+            print(traceback.format_exc())
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+            JOB_RUNS.inc(job.key, job.status)
+            JOB_DURATION.observe(job.key, value=job.finished_at - job.started_at)
+            with self._lock:
+                self._running.pop(job.key, None)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status != 'running']
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
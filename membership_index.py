@@ -0,0 +1,135 @@
+"""In-process index of playlist memberships stored as per-song bitsets."""
+
+import threading
+from typing import Dict, Iterable, List, Set, Tuple
+
+from db import DB_PATH, connect
+
+# Beyond this many changed playlists a full reload is cheaper
+MAX_STALE_PLAYLISTS = 20
+
+
+class MembershipIndex:
+    """Map song and playlist ids to integer positions with one bitset per song.
+
+    Bit ``i`` of a song's bitset is set when the song is in the playlist at
+    position ``i``. Bitsets are plain ints, so a song costs one small int
+    regardless of the number of playlists, and the bitset doubles as the
+    membership mask sent to the browser. Positions are only ever appended,
+    so a mask stays valid together with the playlist list it came with.
+
+    The index loads itself from the database on first use. Toggles update it
+    in place; after a refresh, changed playlists are marked stale and only
+    those are reloaded on the next lookup.
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        # Reentrant, so updates can run inside ``locked()``
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self._loaded = False
+        self._song_positions: Dict[str, int] = {}
+        self._playlist_positions: Dict[str, int] = {}
+        self._playlist_ids: List[str] = []
+        self._bits: List[int] = []
+        self._stale_playlists: Set[str] = set()
+
+    def _song_position(self, song_id: str) -> int:
+        position = self._song_positions.get(song_id)
+        if position is None:
+            position = self._song_positions[song_id] = len(self._bits)
+            self._bits.append(0)
+        return position
+
+    def _playlist_bit(self, playlist_id: str) -> int:
+        position = self._playlist_positions.get(playlist_id)
+        if position is None:
+            position = self._playlist_positions[playlist_id] = len(self._playlist_ids)
+            self._playlist_ids.append(playlist_id)
+        return 1 << position
+
+    def _ensure_fresh(self):
+        """Load the index or reload stale playlists, called with the lock held."""
+        if len(self._stale_playlists) > MAX_STALE_PLAYLISTS:
+            # Clearing each playlist's bit costs a pass over all songs
+            self._clear()
+
+        if not self._loaded:
+            with connect(self.db_path) as conn:
+                rows = conn.execute("SELECT song_id, playlist_id FROM playlist_songs").fetchall()
+            self._stale_playlists.clear()
+            for song_id, playlist_id in rows:
+                self._bits[self._song_position(song_id)] |= self._playlist_bit(playlist_id)
+            self._loaded = True
+            return
+
+        if self._stale_playlists:
+            stale = list(self._stale_playlists)
+            self._stale_playlists.clear()
+            with connect(self.db_path) as conn:
+                for playlist_id in stale:
+                    song_ids = [row[0] for row in conn.execute(
+                        "SELECT song_id FROM playlist_songs WHERE playlist_id = ?", (playlist_id,)
+                    )]
+                    bit = self._playlist_bit(playlist_id)
+                    for position, bits in enumerate(self._bits):
+                        if bits & bit:
+                            self._bits[position] = bits & ~bit
+                    for song_id in song_ids:
+                        self._bits[self._song_position(song_id)] |= bit
+
+    def add(self, song_id: str, playlist_id: str):
+        """Record that a song was added to a playlist."""
+        with self._lock:
+            if self._loaded:
+                self._bits[self._song_position(song_id)] |= self._playlist_bit(playlist_id)
+
+    def remove(self, song_id: str, playlist_id: str):
+        """Record that a song was removed from a playlist."""
+        with self._lock:
+            position = self._song_positions.get(song_id)
+            if self._loaded and position is not None:
+                self._bits[position] &= ~self._playlist_bit(playlist_id)
+
+    def contains(self, song_id: str, playlist_id: str) -> bool:
+        """Check whether a song is in a playlist."""
+        with self._lock:
+            self._ensure_fresh()
+            position = self._song_positions.get(song_id)
+            bit_position = self._playlist_positions.get(playlist_id)
+            if position is None or bit_position is None:
+                return False
+            return bool(self._bits[position] >> bit_position & 1)
+
+    def masks(self, song_ids: Iterable[str]) -> Tuple[List[str], List[int]]:
+        """Return the playlist ids in bit order and the bitset of every song."""
+        with self._lock:
+            self._ensure_fresh()
+            masks = []
+            for song_id in song_ids:
+                position = self._song_positions.get(song_id)
+                masks.append(0 if position is None else self._bits[position])
+            return list(self._playlist_ids), masks
+
+    def locked(self):
+        """Hold off lookups, e.g. while a write commits and updates the index.
+
+        A request that sees the data version the commit bumped then also
+        sees the updated index, so no stale masks are cached under the new
+        version.
+        """
+        return self._lock
+
+    def invalidate_playlist(self, playlist_id: str):
+        """Reload a playlist's memberships from the database on next use."""
+        with self._lock:
+            if self._loaded:
+                self._stale_playlists.add(playlist_id)
+
+    def invalidate(self):
+        """Drop the whole index, it is reloaded on next use."""
+        with self._lock:
+            self._clear()
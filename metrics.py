@@ -0,0 +1,288 @@
+"""In-process metrics in the Prometheus text format, and a request profiler.
+
+Counters, gauges and histograms are kept in memory and rendered by
+``REGISTRY.render()`` for the app's ``/metrics`` endpoint. Time spent in
+SQLite and in Spotify API calls is also added up per request, so the app
+can report where a slow request spent its time.
+"""
+
+import cProfile
+import io
+import itertools
+import pstats
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Upper bounds in seconds, from a fast SQLite lookup to a slow sync
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Profiles kept for /api/profiler, and functions listed per profile
+MAX_PROFILES = 20
+PROFILE_LINES = 30
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Sequence[str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {labels}")
+        return tuple(str(label) for label in labels)
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}'] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A value that only goes up, per combination of label values."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}' for key, value in values]
+
+
+class Gauge(Counter):
+    """A value that can be set to anything."""
+
+    type = 'gauge'
+
+    def set(self, *labels: str, value: float):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, with their sum."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, *labels: str, value: float):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * len(self.buckets), [0.0])
+            counts, total = entry
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            total[0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - start)
+
+    def count(self, *labels: str) -> int:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return sum(entry[0]) if entry else 0
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            for bound, cumulative in zip(self.buckets, itertools.accumulate(counts)):
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {sum(counts)}')
+        return lines
+
+
+class Registry:
+    """The metrics rendered on /metrics, in registration order."""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_DURATION = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'Time to handle a request, by route', ('method', 'route', 'status')
+))
+TEMPLATE_RENDER_DURATION = REGISTRY.register(Histogram(
+    'template_render_duration_seconds', 'Time to render a Jinja template', ('template',)
+))
+SPOTIFY_REQUEST_DURATION = REGISTRY.register(Histogram(
+    'spotify_request_duration_seconds', 'Spotify API calls including their retries, by endpoint',
+    ('method', 'endpoint', 'status')
+))
+SPOTIFY_RETRIES = REGISTRY.register(Counter(
+    'spotify_retries_total', 'Spotify API attempts that were retried, by endpoint and cause',
+    ('method', 'endpoint', 'reason')
+))
+SQLITE_QUERY_DURATION = REGISTRY.register(Histogram(
+    'sqlite_query_duration_seconds', 'Time to execute a SQLite statement, by statement type', ('operation',)
+))
+SYNC_ITEMS = REGISTRY.register(Counter(
+    'sync_items_total', 'Items processed by syncs, by progress counter', ('counter',)
+))
+SYNC_PROGRESS = REGISTRY.register(Gauge(
+    'sync_progress', 'Latest value of progress counters that are set rather than added to', ('counter',)
+))
+JOB_RUNS = REGISTRY.register(Counter(
+    'job_runs_total', 'Finished background jobs, by outcome', ('job', 'status')
+))
+JOB_DURATION = REGISTRY.register(Histogram(
+    'job_duration_seconds', 'Run time of background jobs', ('job',)
+))
+
+
+class RequestTimings:
+    """Seconds spent per component by the current thread's request.
+
+    Only work done on the request's own thread is counted; pages fetched by
+    worker threads show up in the histograms but not here.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def start(self):
+        self._local.timings = {}
+
+    def add(self, component: str, seconds: float):
+        timings = getattr(self._local, 'timings', None)
+        if timings is not None:
+            timings[component] = timings.get(component, 0.0) + seconds
+
+    def finish(self) -> Dict[str, float]:
+        timings = getattr(self._local, 'timings', None) or {}
+        self._local.timings = None
+        return timings
+
+
+request_timings = RequestTimings()
+
+
+def observe_sqlite(operation: str, seconds: float):
+    SQLITE_QUERY_DURATION.observe(operation, value=seconds)
+    request_timings.add('db', seconds)
+
+
+def observe_spotify(method: str, endpoint: str, status: str, seconds: float):
+    SPOTIFY_REQUEST_DURATION.observe(method, endpoint, status, value=seconds)
+    request_timings.add('spotify', seconds)
+
+
+class RequestProfiler:
+    """Profile requests with cProfile while switched on.
+
+    Only one request is profiled at a time, since Python allows a single
+    active profiler; requests arriving meanwhile run unprofiled. The last
+    ``MAX_PROFILES`` reports are kept.
+    """
+
+    def __init__(self, max_profiles: int = MAX_PROFILES):
+        self.enabled = False
+        self._busy = threading.Lock()
+        self._ids = itertools.count(1)
+        self._profiles: Deque[Dict] = deque(maxlen=max_profiles)
+        self._lock = threading.Lock()
+
+    def start(self) -> Optional[cProfile.Profile]:
+        """Start profiling the current request if enabled and not busy."""
+        if not self.enabled or not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiling tool is active
+            self._busy.release()
+            return None
+        return profile
+
+    def finish(self, profile: cProfile.Profile, method: str, path: str, seconds: float):
+        profile.disable()
+        self._busy.release()
+
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        with self._lock:
+            self._profiles.append({
+                'id': next(self._ids),
+                'method': method,
+                'path': path,
+                'duration_ms': round(seconds * 1000, 1),
+                'finished_at': time.time(),
+                'stats': output.getvalue()
+            })
+
+    def profiles(self) -> List[Dict]:
+        with self._lock:
+            return list(self._profiles)
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
@@ -0,0 +1,64 @@
+"""Concurrent offset-based paging for the Spotify Web API."""
+
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# Number of requests kept in flight by default
+DEFAULT_MAX_WORKERS = 4
+
+
+def map_in_order(fn: Callable[[T], R], args: Iterable[T],
+                 max_workers: int = DEFAULT_MAX_WORKERS) -> Iterator[R]:
+    """Apply fn to args on a thread pool and yield results in input order.
+
+    At most ``max_workers`` calls are in flight at any time, so results are
+    never buffered far ahead of the consumer. Closing the iterator early
+    cancels calls that have not started yet. Calls run in a copy of the
+    caller's context, so they keep its request priority.
+    """
+    args = iter(args)
+    if max_workers <= 1:
+        for arg in args:
+            yield fn(arg)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        try:
+            while True:
+                for arg in islice(args, max_workers - len(pending)):
+                    pending.append(pool.submit(contextvars.copy_context().run, fn, arg))
+                if not pending:
+                    return
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def iter_pages(fetch_page: Callable[[int, int], Dict[str, Any]], limit: int,
+               max_workers: int = DEFAULT_MAX_WORKERS) -> Iterator[Dict[str, Any]]:
+    """Yield every page of a paginated endpoint in offset order.
+
+    ``fetch_page(offset, limit)`` must return a Spotify paging object. The
+    first page is fetched on its own to learn ``total``, the remaining offsets
+    are then requested concurrently.
+    """
+    first = fetch_page(0, limit)
+    yield first
+
+    offsets = range(limit, first['total'], limit)
+    yield from map_in_order(lambda offset: fetch_page(offset, limit), offsets, max_workers)
+
+
+def iter_items(fetch_page: Callable[[int, int], Dict[str, Any]], limit: int,
+               max_workers: int = DEFAULT_MAX_WORKERS) -> Iterator[Dict[str, Any]]:
+    """Yield the items of every page of a paginated endpoint in order."""
+    for page in iter_pages(fetch_page, limit, max_workers):
+        yield from page['items']
@@ -0,0 +1,318 @@
+"""Shared playback state polling for every open tab of a user."""
+
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from spotipy.exceptions import SpotifyException
+
+# Seconds between polls while something is playing and while paused
+PLAYING_INTERVAL = 1.0
+PAUSED_INTERVAL = 5.0
+
+# Polls back off up to this many seconds while Spotify keeps failing
+MAX_ERROR_INTERVAL = 30.0
+
+# Status requests within this many seconds of a poll reuse its result
+MAX_AGE = 0.5
+
+# Seconds after a play command during which polls still showing the
+# previous track are ignored
+PLAY_SETTLE_TIME = 2.0
+
+# Subscribers get None after this many seconds without a change, so a
+# stream can send a keep-alive and notice closed connections
+KEEPALIVE_INTERVAL = 15.0
+
+IDLE_STATE = {
+    'is_playing': False,
+    'progress_ms': 0,
+    'duration_ms': 0,
+    'track_id': None,
+    'device_id': None
+}
+
+
+class NoActiveDevice(Exception):
+    """No Spotify device is available to play on."""
+
+
+def _is_device_error(error: Exception) -> bool:
+    """Spotify answers 404 for a gone device and 403 for an invalid command."""
+    return isinstance(error, SpotifyException) and error.http_status in (403, 404)
+
+
+class PlaybackPoller:
+    """Poll one user's playback state and share it between requests.
+
+    ``status`` returns a recent state; concurrent callers that find it stale
+    wait for a single ``current_playback`` call instead of making their own.
+    While at least one ``subscribe`` iterator is open, a background thread
+    polls every second during playback and every few seconds otherwise, and
+    publishes each new state to all subscribers. Without subscribers it
+    stops polling.
+    """
+
+    def __init__(self, client, playing_interval: float = PLAYING_INTERVAL,
+                 paused_interval: float = PAUSED_INTERVAL):
+        self.client = client
+        self.playing_interval = playing_interval
+        self.paused_interval = paused_interval
+
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._state: Optional[Dict[str, Any]] = None
+        self._error: Optional[Exception] = None
+        self._fetched_at = 0.0
+        self._fetching = False
+        self._version = 0
+        self._subscribers = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def status(self, max_age: float = MAX_AGE) -> Dict[str, Any]:
+        """Return the playback state, fetching it if older than ``max_age``."""
+        with self._cond:
+            while True:
+                if self._fetched_at and time.monotonic() - self._fetched_at <= max_age:
+                    if self._error is not None:
+                        raise self._error
+                    return self._state
+                if not self._fetching:
+                    self._fetching = True
+                    break
+                self._cond.wait()
+
+        state, error = None, None
+        try:
+            state = self._fetch()
+        except Exception as e:
+            error = e
+        finally:
+            with self._cond:
+                self._fetching = False
+                self._fetched_at = time.monotonic()
+                self._error = error
+                if error is None:
+                    self._state = state
+                    self._version += 1
+                self._cond.notify_all()
+        if error is not None:
+            raise error
+        return state
+
+    def latest(self) -> Tuple[Optional[Dict[str, Any]], float]:
+        """Return the last fetched state and when it was fetched, without fetching."""
+        with self._cond:
+            return self._state, self._fetched_at
+
+    def nudge(self):
+        """Mark the state stale and poll now, e.g. after starting playback."""
+        with self._cond:
+            self._fetched_at = 0.0
+        self._wake.set()
+
+    def subscribe(self) -> Iterator[Optional[Dict[str, Any]]]:
+        """Yield the current state and then every new one.
+
+        ``None`` is yielded when nothing changed for ``KEEPALIVE_INTERVAL``
+        seconds. Closing the iterator unsubscribes.
+        """
+        with self._cond:
+            self._subscribers += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='playback-poller', daemon=True)
+                self._thread.start()
+            seen = self._version if self._state is None else -1
+        try:
+            while True:
+                with self._cond:
+                    if self._version == seen:
+                        self._cond.wait(KEEPALIVE_INTERVAL)
+                    if self._version == seen:
+                        state = None
+                    else:
+                        seen, state = self._version, self._state
+                yield state
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+
+    def _fetch(self) -> Dict[str, Any]:
+        playback = self.client.current_playback()
+        if not playback or not playback.get('item'):
+            return dict(IDLE_STATE)
+        return {
+            'is_playing': bool(playback['is_playing']),
+            'progress_ms': playback['progress_ms'] or 0,
+            'duration_ms': playback['item']['duration_ms'],
+            'track_id': playback['item']['id'],
+            'device_id': (playback.get('device') or {}).get('id')
+        }
+
+    def _run(self):
+        error_interval = self.paused_interval
+        while True:
+            with self._cond:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+
+            try:
+                state = self.status()
+                interval = self.playing_interval if state['is_playing'] else self.paused_interval
+                error_interval = self.paused_interval
+            except Exception as e:
+                print(f"Playback poll failed: {e}")
+                interval = error_interval
+                error_interval = min(error_interval * 2, MAX_ERROR_INTERVAL)
+
+            self._wake.wait(interval)
+            self._wake.clear()
+
+
+class PlaybackController:
+    """Send play, pause and seek commands without asking Spotify first.
+
+    The device playback was last started on is reused, and the position of
+    the current track is extrapolated from the last command or poll, so a
+    command is a single API call. Only when Spotify rejects a command because
+    the device is gone or the player is in another state is the state
+    fetched again and the command retried.
+    """
+
+    def __init__(self, client, poller: Optional[PlaybackPoller] = None):
+        self.client = client
+        self.poller = poller or PlaybackPoller(client)
+        self._lock = threading.Lock()
+        self._device_id: Optional[str] = None
+        self._track_id: Optional[str] = None
+        self._duration_ms: Optional[int] = None
+        self._playing = False
+        self._position_ms = 0
+        self._position_at = 0.0
+        self._played_at = 0.0
+
+    def play(self, song_id: str):
+        """Start a track on the cached device, picking a device if needed."""
+        device_id = self._device_id or self._pick_device()
+        try:
+            self.client.start_playback(device_id=device_id, uris=[f'spotify:track:{song_id}'])
+        except Exception as e:
+            if not _is_device_error(e):
+                raise
+            device_id = self._pick_device()
+            self.client.start_playback(device_id=device_id, uris=[f'spotify:track:{song_id}'])
+
+        with self._lock:
+            self._device_id = device_id
+            self._track_id = song_id
+            self._duration_ms = None
+            self._set_position(0, playing=True)
+            self._played_at = self._position_at
+        self.poller.nudge()
+
+    def pause(self):
+        """Pause playback on the cached device."""
+        self._adopt_poll()
+        try:
+            self.client.pause_playback(device_id=self._device_id)
+        except Exception as e:
+            if not _is_device_error(e):
+                raise
+            # Pausing a paused player is refused, anything else is retried
+            if self._sync()['is_playing']:
+                self.client.pause_playback(device_id=self._device_id)
+
+        with self._lock:
+            self._set_position(self._estimate(), playing=False)
+        self.poller.nudge()
+
+    def seek(self, offset_ms: int) -> int:
+        """Seek relative to the current position and return the new one."""
+        self._adopt_poll()
+        with self._lock:
+            known = self._position_at and self._duration_ms is not None
+        if not known and self._sync()['track_id'] is None:
+            raise NoActiveDevice('No active playback')
+
+        with self._lock:
+            position_ms = self._clamp(self._estimate() + offset_ms)
+            device_id = self._device_id
+        try:
+            self.client.seek_track(position_ms, device_id=device_id)
+        except Exception as e:
+            if not _is_device_error(e):
+                raise
+            self._sync()
+            with self._lock:
+                position_ms = self._clamp(self._estimate() + offset_ms)
+            self.client.seek_track(position_ms, device_id=self._device_id)
+
+        with self._lock:
+            self._set_position(position_ms, playing=self._playing)
+        self.poller.nudge()
+        return position_ms
+
+    def _pick_device(self) -> str:
+        devices = self.client.devices()['devices']
+        if not devices:
+            raise NoActiveDevice('No active devices found')
+        active_devices = [d for d in devices if d['is_active']]
+        return active_devices[0]['id'] if active_devices else devices[0]['id']
+
+    def _sync(self) -> Dict[str, Any]:
+        """Fetch the playback state now and adopt it."""
+        state = self.poller.status(max_age=0)
+        self._adopt_poll(force=True)
+        return state
+
+    def _adopt_poll(self, force: bool = False):
+        """Take over a poll that is newer than the last command."""
+        state, fetched_at = self.poller.latest()
+        with self._lock:
+            if state is None or fetched_at <= self._position_at:
+                return
+            # Right after a play command Spotify may still report the old track
+            if (not force and state['track_id'] != self._track_id
+                    and fetched_at - self._played_at < PLAY_SETTLE_TIME):
+                return
+            if state['track_id'] is None:
+                self._playing = False
+                return
+            self._device_id = state['device_id'] or self._device_id
+            self._track_id = state['track_id']
+            self._duration_ms = state['duration_ms']
+            self._playing = state['is_playing']
+            self._position_ms = state['progress_ms']
+            self._position_at = fetched_at
+
+    def _set_position(self, position_ms: int, playing: bool):
+        self._position_ms = position_ms
+        self._position_at = time.monotonic()
+        self._playing = playing
+
+    def _estimate(self) -> int:
+        position_ms = self._position_ms
+        if self._playing:
+            position_ms += int((time.monotonic() - self._position_at) * 1000)
+        return self._clamp(position_ms)
+
+    def _clamp(self, position_ms: int) -> int:
+        if self._duration_ms is not None:
+            position_ms = min(position_ms, self._duration_ms)
+        return max(0, position_ms)
+
+
+class PlaybackControllers:
+    """Keep one controller, and with it one poller, per user."""
+
+    def __init__(self):
+        self._controllers: Dict[str, PlaybackController] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, client) -> PlaybackController:
+        with self._lock:
+            controller = self._controllers.get(key)
+            if controller is None:
+                controller = self._controllers[key] = PlaybackController(client)
+            return controller
@@ -1,16 +1,76 @@
 # this file is run only once, initially, to create the database
 
+import threading
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
-import sqlite3
-from pathlib import Path
+import numpy as np
 import pandas as pd
-from typing import Dict, List, Set
-import envvars
+from typing import Any, Dict, List, Optional
+from db import DB_PATH, SET_META, UPSERT_LIKED_SONG, UPSERT_PLAYLIST, BatchWriter, connect, get_meta, init_schema
+from metrics import SYNC_ITEMS, SYNC_PROGRESS
+from pagination import DEFAULT_MAX_WORKERS, iter_items, iter_pages, map_in_order
+
+class SyncCancelled(Exception):
+    """Raised inside a sync once its progress has been cancelled."""
+
+class SyncProgress:
+    """Counters a sync updates as it goes, and a flag to cancel it.
+
+    Every update checks the flag, so a cancelled sync stops at its next page
+    or playlist. Writes are only ever interrupted between transactions.
+    Updates are also exported as sync metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self.stage: Optional[str] = None
+        self.counts: Dict[str, int] = {}
+
+    def start_stage(self, stage: str):
+        self.check()
+        with self._lock:
+            self.stage = stage
+
+    def add(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+        SYNC_ITEMS.inc(name, amount=amount)
+        self.check()
+
+    def set(self, name: str, value: int):
+        with self._lock:
+            self.counts[name] = value
+        SYNC_PROGRESS.set(name, value=value)
+        self.check()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self):
+        """Raise SyncCancelled if the sync was cancelled."""
+        if self._cancelled.is_set():
+            raise SyncCancelled()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'stage': self.stage, 'counts': dict(self.counts)}
 
 class SpotifyAnalyzer:
-    def __init__(self, spotify_client=None, client_id=None, client_secret=None, redirect_uri=None):
-        """Initialize with existing client or create new one."""
+    def __init__(self, spotify_client=None, client_id=None, client_secret=None, redirect_uri=None,
+                 max_workers: int = DEFAULT_MAX_WORKERS, db_path=DB_PATH, membership_index=None,
+                 progress: Optional[SyncProgress] = None):
+        """Initialize with existing client or create new one.
+
+        ``max_workers`` bounds the number of concurrent Spotify requests made
+        while paging and while fetching playlists. A ``membership_index`` is
+        told about every playlist the sync rewrites. ``progress`` receives
+        the sync's counters and can cancel it.
+        """
         if spotify_client:
             self.sp = spotify_client
         else:
@@ -21,140 +81,321 @@ class SpotifyAnalyzer:
                 scope="user-library-read playlist-read-private playlist-modify-public playlist-modify-private"
             ))
         
-        self.db_path = Path("spotify_cache.db")
+        self.max_workers = max_workers
+        self.membership_index = membership_index
+        self.progress = progress or SyncProgress()
+        self.db_path = db_path
+        self.user_id: Optional[str] = None
+        self.playlists: List[Dict] = []
+        # What the last sync added and removed, by kind
+        self.report: Dict[str, List[Dict]] = {}
         self.init_db()
     
     
     def init_db(self):
         """Initialize SQLite database with required tables."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.executescript("""
-                CREATE TABLE IF NOT EXISTS liked_songs (
-                    id TEXT PRIMARY KEY,
-                    name TEXT,
-                    artist TEXT,
-                    added_at TIMESTAMP
-                );
-                
-                CREATE TABLE IF NOT EXISTS playlists (
-                    id TEXT PRIMARY KEY,
-                    name TEXT,
-                    owner_id TEXT
-                );
-                
-                CREATE TABLE IF NOT EXISTS playlist_songs (
-                    playlist_id TEXT,
-                    song_id TEXT,
-                    FOREIGN KEY(playlist_id) REFERENCES playlists(id),
-                    FOREIGN KEY(song_id) REFERENCES liked_songs(id),
-                    PRIMARY KEY(playlist_id, song_id)
-                );
-
-                CREATE TABLE IF NOT EXISTS played_history (
-                    song_id TEXT,
-                    played_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY(song_id) REFERENCES liked_songs(id),
-                    PRIMARY KEY(song_id, played_at)
-                );
-            """)
+        init_schema(self.db_path)
     
 
-    def fetch_all_liked_songs(self):
-        """Fetch all liked songs and store in database."""
-        print("Fetching liked songs...")
-        results = self.sp.current_user_saved_tracks()
-        count = 0
-        
-        with sqlite3.connect(self.db_path) as conn:
-            while results:
-                for item in results['items']:
-                    track = item['track']
-                    conn.execute("""
-                        INSERT OR REPLACE INTO liked_songs (id, name, artist, added_at)
-                        VALUES (?, ?, ?, ?)
-                    """, (
-                        track['id'],
-                        track['name'],
-                        track['artists'][0]['name'],
-                        item['added_at']
-                    ))
-                    count += 1
-                
-                if results['next']:
-                    results = self.sp.next(results)
-                else:
-                    results = None
-        
-        print(f"Stored {count} liked songs")
+    def fetch_all_liked_songs(self, full_resync: bool = False):
+        """Fetch liked songs, store them and remove the ones no longer liked.
+
+        Saved tracks come back newest-first, so by default paging stops at the
+        first track that is already stored at or below the newest ``added_at``
+        in the database. Pass ``full_resync=True`` to page through the whole
+        library instead. A sync that was interrupted leaves a gap below the
+        songs it stored, so the next one pages through everything as well.
+
+        Removals are found from the same download: every id seen goes into a
+        temporary table, and stored songs missing from it are deleted. An
+        incremental sync only pages on through the rest of the library when
+        the number of stored songs no longer matches Spotify's total.
+        """
+        self.progress.start_stage('liked_songs')
+        fetch_page = lambda offset, limit: self.sp.current_user_saved_tracks(limit=limit, offset=offset)
+        added: Dict[str, Dict] = {}
+        removed: List[Dict] = []
+
+        with BatchWriter(self.db_path) as writer:
+            high_water_mark = None
+            if not full_resync and get_meta(writer.conn, 'liked_songs_complete') == '1':
+                high_water_mark = writer.conn.execute(
+                    "SELECT MAX(added_at) FROM liked_songs"
+                ).fetchone()[0]
+            # Committed with the first batch and only reset once all are in
+            writer.execute(SET_META, ('liked_songs_complete', '0'))
+            writer.conn.execute("DROP TABLE IF EXISTS temp.seen_songs")
+            writer.conn.execute("CREATE TEMP TABLE seen_songs (id TEXT PRIMARY KEY)")
+
+            if high_water_mark:
+                print(f"Fetching liked songs added since {high_water_mark}...")
+            else:
+                print("Fetching all liked songs...")
+
+            # An incremental sync usually ends on the first page, so it pages
+            # serially instead of requesting pages past the high-water mark
+            pages = iter_pages(
+                fetch_page,
+                limit=50,
+                max_workers=1 if high_water_mark else self.max_workers
+            )
+            complete = True
+            for page in pages:
+                total = page['total']
+                items = []
+                for item in page['items']:
+                    if high_water_mark and self._is_known_song(writer.conn, item, high_water_mark):
+                        complete = False
+                        break
+                    items.append(item)
+                self._store_liked_page(writer, items, added)
+                if not complete:
+                    pages.close()
+                    break
+
+            if not complete:
+                writer.flush()
+                stored = writer.conn.execute("SELECT COUNT(*) FROM liked_songs").fetchone()[0]
+                if stored != total:
+                    # Songs were unliked, page on from where the new ones ended
+                    print(f"{stored} songs stored but {total} liked, checking the whole library...")
+                    offsets = range(page['offset'], total, 50)
+                    for page in map_in_order(lambda offset: fetch_page(offset, 50), offsets, self.max_workers):
+                        self._store_liked_page(writer, page['items'], added)
+                    complete = True
+
+            if complete:
+                removed = self._remove_unseen_songs(writer)
+            writer.execute(SET_META, ('liked_songs_complete', '1'))
+
+        if removed and self.membership_index:
+            self.membership_index.invalidate()
+
+        self.report['songs_added'] = list(added.values())
+        self.report['songs_removed'] = removed
+        self.progress.set('songs_added', len(added))
+        self.progress.set('songs_removed', len(removed))
+        print(f"Liked songs: {len(added)} added, {len(removed)} removed")
+        for song in removed:
+            print(f"- Removed '{song['name']}' by {song['artist']}")
+
+    def _store_liked_page(self, writer: BatchWriter, items: List[Dict], added: Dict[str, Dict]):
+        """Upsert a page of saved tracks and remember their ids as seen."""
+        self.progress.add('liked_pages')
+        items = [item for item in items if item['track'] and item['track']['id']]
+        ids = [item['track']['id'] for item in items]
+        stored = set()
+        if ids:
+            placeholders = ','.join('?' * len(ids))
+            stored = {row[0] for row in writer.conn.execute(
+                f"SELECT id FROM liked_songs WHERE id IN ({placeholders})", ids
+            )}
+        for item in items:
+            track = item['track']
+            song = {
+                'id': track['id'],
+                'name': track['name'],
+                'artist': track['artists'][0]['name'] if track['artists'] else 'Unknown',
+                'added_at': item['added_at']
+            }
+            if song['id'] not in stored:
+                added.setdefault(song['id'], song)
+            writer.execute(UPSERT_LIKED_SONG, (song['id'], song['name'], song['artist'], song['added_at']))
+        writer.executemany("INSERT OR IGNORE INTO temp.seen_songs (id) VALUES (?)", [(song_id,) for song_id in ids])
+        self.progress.add('liked_songs', len(items))
+
+    def _remove_unseen_songs(self, writer: BatchWriter) -> List[Dict]:
+        """Delete stored songs that were not in the download.
+
+        Their ``playlist_songs`` rows stay: the song is still in those
+        playlists on Spotify, and unchanged playlists are not refetched, so
+        the rows would not come back if the song is liked again. Every reader
+        starts from ``liked_songs`` and never sees them meanwhile.
+        """
+        writer.flush()
+        unseen = "NOT EXISTS (SELECT 1 FROM temp.seen_songs seen WHERE seen.id = liked_songs.id)"
+        removed = [dict(zip(('id', 'name', 'artist'), row)) for row in writer.conn.execute(
+            f"SELECT id, name, artist FROM liked_songs WHERE {unseen}"
+        )]
+        if removed:
+            writer.execute(f"DELETE FROM liked_songs WHERE {unseen}")
+            writer.flush()
+        return removed
+
+    @staticmethod
+    def _is_known_song(conn, item, high_water_mark: str) -> bool:
+        """Check whether a saved-tracks item is already covered by the database."""
+        if item['added_at'] < high_water_mark:
+            return True
+        if item['added_at'] > high_water_mark:
+            return False
+        # Several tracks can share the newest timestamp, only stop at a stored one
+        return conn.execute(
+            "SELECT 1 FROM liked_songs WHERE id = ?", (item['track']['id'],)
+        ).fetchone() is not None
     
 
-    def fetch_all_playlists(self):
-        """Fetch all user playlists and their songs."""
+    def fetch_all_playlists(self, full_resync: bool = False):
+        """Fetch all user playlists and the songs of changed owned playlists.
+
+        Owned playlists whose ``snapshot_id`` matches the stored one are
+        skipped; changed ones get their ``playlist_songs`` rows rebuilt. Pass
+        ``full_resync=True`` to refetch every owned playlist. Stored playlists
+        missing from the user's complete list are deleted.
+
+        The skip trusts that a playlist's stored rows still match its stored
+        snapshot, so nothing else may delete them without clearing it:
+        unliking a song keeps its memberships, and local toggles are followed
+        by a new snapshot on Spotify.
+        """
         print("Fetching playlists...")
-        playlists = self.sp.current_user_playlists()
+        self.progress.start_stage('playlists')
+        playlists = list(iter_items(
+            lambda offset, limit: self.sp.current_user_playlists(limit=limit, offset=offset),
+            limit=50,
+            max_workers=self.max_workers
+        ))
         
         # Get current user id
         user_info = self.sp.current_user()
         user_id = user_info['id']
         print(f"Current user: {user_id}")
         
+        # Kept so callers can reuse the catalogue without refetching it
+        self.user_id = user_id
+        self.playlists = playlists
+        
         own_playlist_count = 0
+        unchanged_playlist_count = 0
         followed_playlist_count = 0
         total_tracks = 0
         
-        with sqlite3.connect(self.db_path) as conn:
-            while playlists:
-                for playlist in playlists['items']:
-                    # Store playlist info with owner
-                    conn.execute("""
-                        INSERT OR REPLACE INTO playlists (id, name, owner_id)
-                        VALUES (?, ?, ?)
-                    """, (
+        changed_playlists = []
+        removed_playlists = []
+        try:
+            with BatchWriter(self.db_path) as writer:
+                # Lets exports tell owned playlists apart without calling Spotify
+                writer.execute(SET_META, ('user_id', user_id))
+                stored_snapshots = dict(writer.conn.execute("SELECT id, snapshot_id FROM playlists"))
+                self.report['playlists_added'] = [
+                    {'id': playlist['id'], 'name': playlist['name']}
+                    for playlist in playlists if playlist['id'] not in stored_snapshots
+                ]
+                removed_playlists = self._remove_unseen_playlists(writer, playlists)
+                self.report['playlists_removed'] = removed_playlists
+
+                for playlist in playlists:
+                    # Store playlist info with owner, the snapshot is only
+                    # recorded once the tracks have been stored
+                    writer.execute(UPSERT_PLAYLIST, (
                         playlist['id'],
                         playlist['name'],
                         playlist['owner']['id']
                     ))
-                    
+                
                     # Only fetch tracks for owned playlists
-                    if playlist['owner']['id'] == user_id:
-                        own_playlist_count += 1
-                        print(f"Fetching tracks for owned playlist: {playlist['name']}")
-                        
-                        # Fetch and store all tracks in playlist
-                        results = self.sp.playlist_tracks(playlist['id'])
-                        while results:
-                            for item in results['items']:
-                                if item['track']:  # Some tracks might be None due to availability
-                                    conn.execute("""
-                                        INSERT OR IGNORE INTO playlist_songs (playlist_id, song_id)
-                                        VALUES (?, ?)
-                                    """, (playlist['id'], item['track']['id']))
-                                    total_tracks += 1
-                            
-                            if results['next']:
-                                results = self.sp.next(results)
-                            else:
-                                results = None
-                    else:
+                    if playlist['owner']['id'] != user_id:
                         followed_playlist_count += 1
                         print(f"Skipping tracks for followed playlist: {playlist['name']}")
-                
-                if playlists['next']:
-                    playlists = self.sp.next(playlists)
-                else:
-                    playlists = None
+                        continue
+
+                    own_playlist_count += 1
+                    snapshot_id = playlist.get('snapshot_id')
+                    if (not full_resync and snapshot_id
+                            and stored_snapshots.get(playlist['id']) == snapshot_id):
+                        unchanged_playlist_count += 1
+                    else:
+                        changed_playlists.append(playlist)
+
+                # Tracks of several playlists are fetched at once, but written in
+                # playlist order from this thread. Each playlist is rewritten in
+                # one transaction so readers never see it half-filled.
+                writer.flush()
+                self.progress.set('playlists_total', len(changed_playlists))
+                fetched = map_in_order(self._fetch_playlist_song_ids, changed_playlists, self.max_workers)
+                for playlist, song_ids in zip(changed_playlists, fetched):
+                    print(f"Fetched {len(song_ids)} tracks for owned playlist: {playlist['name']}")
+                    with writer.group():
+                        writer.execute(
+                            "DELETE FROM playlist_songs WHERE playlist_id = ?",
+                            (playlist['id'],)
+                        )
+                        writer.executemany("""
+                            INSERT OR IGNORE INTO playlist_songs (playlist_id, song_id)
+                            VALUES (?, ?)
+                        """, [(playlist['id'], song_id) for song_id in song_ids])
+                        writer.execute(
+                            "UPDATE playlists SET snapshot_id = ? WHERE id = ?",
+                            (playlist.get('snapshot_id'), playlist['id'])
+                        )
+                    total_tracks += len(song_ids)
+                    try:
+                        self.progress.add('playlists_done')
+                    except SyncCancelled:
+                        # Keep the playlists that were fetched completely
+                        writer.flush()
+                        raise
+        finally:
+            # Only after the writer has committed, so a reload sees the new rows
+            if self.membership_index:
+                for playlist in changed_playlists + removed_playlists:
+                    self.membership_index.invalidate_playlist(playlist['id'])
         
         print(f"\nSummary:")
-        print(f"- Own playlists: {own_playlist_count}")
+        print(f"- Own playlists: {own_playlist_count} ({unchanged_playlist_count} unchanged)")
         print(f"- Followed playlists: {followed_playlist_count}")
-        print(f"- Total tracks in own playlists: {total_tracks}")
+        print(f"- Tracks fetched from changed playlists: {total_tracks}")
+        print(f"- Playlists added: {len(self.report['playlists_added'])}, removed: {len(removed_playlists)}")
+        for playlist in removed_playlists:
+            print(f"  - Removed '{playlist['name']}'")
+
+    @staticmethod
+    def _remove_unseen_playlists(writer: BatchWriter, playlists: List[Dict]) -> List[Dict]:
+        """Delete stored playlists that are not in ``playlists``, with their songs."""
+        writer.conn.execute("DROP TABLE IF EXISTS temp.seen_playlists")
+        writer.conn.execute("CREATE TEMP TABLE seen_playlists (id TEXT PRIMARY KEY)")
+        writer.executemany(
+            "INSERT OR IGNORE INTO temp.seen_playlists (id) VALUES (?)",
+            [(playlist['id'],) for playlist in playlists]
+        )
+        writer.flush()
+
+        unseen = "NOT EXISTS (SELECT 1 FROM temp.seen_playlists seen WHERE seen.id = playlists.id)"
+        removed = [dict(zip(('id', 'name'), row)) for row in writer.conn.execute(
+            f"SELECT id, name FROM playlists WHERE {unseen}"
+        )]
+        if removed:
+            with writer.group():
+                writer.execute(f"DELETE FROM playlist_songs WHERE playlist_id IN (SELECT id FROM playlists WHERE {unseen})")
+                writer.execute(f"DELETE FROM playlists WHERE {unseen}")
+            writer.flush()
+        return removed
+
+    def _fetch_playlist_song_ids(self, playlist: Dict) -> List[str]:
+        """Fetch the ids of all available tracks in a playlist.
+
+        Pages are fetched one after the other: this runs on the playlist
+        pool, which already keeps ``max_workers`` requests in flight.
+        """
+        items = iter_items(
+            lambda offset, limit: self.sp.playlist_tracks(playlist['id'], limit=limit, offset=offset),
+            limit=100,
+            max_workers=1
+        )
+        # Some tracks might be None due to availability
+        return [item['track']['id'] for item in items if item['track']]
     
 
-    def analyze_songs(self) -> pd.DataFrame:
-        """Create a DataFrame showing which songs are in which playlists."""
-        with sqlite3.connect(self.db_path) as conn:
+    def analyze_songs(self, user_id: Optional[str] = None) -> pd.DataFrame:
+        """Create a DataFrame showing which songs are in which playlists.
+
+        Playlists owned by ``user_id`` become 0/1 columns; the current user is
+        looked up on Spotify when no id is given.
+        """
+        with connect(self.db_path) as conn:
             # Get current user id
-            user_id = self.sp.current_user()['id']
+            if user_id is None:
+                user_id = self.sp.current_user()['id']
             
             # Get all liked songs
             liked_songs = pd.read_sql("""
@@ -178,47 +419,24 @@ class SpotifyAnalyzer:
                 WHERE p.owner_id = ?
             """, conn, params=[user_id])
             
-            # Create pivot table with all possible combinations
-            # First, get all possible song_id x playlist_id combinations
-            all_songs = liked_songs['id']
-            all_playlists = playlists['id']
+            # Map ids to integer codes and set one cell per membership, which
+            # keeps the cost linear in the number of memberships. Playlist
+            # columns stay sorted by id like the pivot table they replace.
+            playlist_ids = np.sort(playlists['id'].to_numpy())
+            song_codes = pd.Index(liked_songs['id']).get_indexer(memberships['song_id'])
+            playlist_codes = pd.Index(playlist_ids).get_indexer(memberships['playlist_id'])
+            # Memberships of songs that are not liked get code -1
+            known = (song_codes >= 0) & (playlist_codes >= 0)
             
-            # Create a MultiIndex with all combinations
-            multi_idx = pd.MultiIndex.from_product(
-                [all_songs, all_playlists],
-                names=['song_id', 'playlist_id']
-            )
-            
-            # Reindex memberships to include all combinations
-            full_memberships = pd.DataFrame(
-                index=multi_idx
-            ).reset_index()
-            
-            # Merge with actual memberships
-            full_memberships['exists'] = full_memberships.apply(
-                lambda x: 1 if memberships[
-                    (memberships['song_id'] == x['song_id']) & 
-                    (memberships['playlist_id'] == x['playlist_id'])
-                ].shape[0] > 0 else 0,
-                axis=1
-            )
-            
-            # Create pivot table
-            pivot = pd.pivot_table(
-                full_memberships,
-                values='exists',
-                index='song_id',
-                columns='playlist_id',
-                fill_value=0
-            )
+            # Float like the mean-aggregated pivot table of the old version
+            matrix = np.zeros((len(liked_songs), len(playlist_ids)), dtype=np.float64)
+            matrix[song_codes[known], playlist_codes[known]] = 1
             
             # Merge with song info
-            result = liked_songs.merge(
-                pivot,
-                left_on='id',
-                right_index=True,
-                how='left'
-            )
+            result = pd.concat([
+                liked_songs,
+                pd.DataFrame(matrix, columns=playlist_ids, index=liked_songs.index)
+            ], axis=1)
             
             # Rename playlist columns to playlist names
             playlist_names = dict(zip(playlists.id, playlists.name))
@@ -227,86 +445,28 @@ class SpotifyAnalyzer:
             return result
 
 
-    def cleanup_deleted_items(self):
-        """Remove items that no longer exist in Spotify."""
-        print("Starting cleanup of deleted items...")
-        
-        # Get current state from Spotify
-        current_songs = set()
-        results = self.sp.current_user_saved_tracks()
-        while results:
-            for item in results['items']:
-                current_songs.add(item['track']['id'])
-            if results['next']:
-                results = self.sp.next(results)
-            else:
-                results = None
-        
-        current_playlists = {
-            p['id'] 
-            for p in self.sp.current_user_playlists()['items']
-        }
-        
-        with sqlite3.connect(self.db_path) as conn:
-            # Get counts before cleanup
-            before_songs = conn.execute("SELECT COUNT(*) FROM liked_songs").fetchone()[0]
-            before_playlists = conn.execute("SELECT COUNT(*) FROM playlists").fetchone()[0]
-            before_memberships = conn.execute("SELECT COUNT(*) FROM playlist_songs").fetchone()[0]
-            
-            # Remove deleted songs
-            if current_songs:
-                placeholders = ','.join('?' * len(current_songs))
-                conn.execute(f"""
-                    DELETE FROM liked_songs 
-                    WHERE id NOT IN ({placeholders})
-                """, list(current_songs))
-            
-            # Remove deleted playlists
-            if current_playlists:
-                placeholders = ','.join('?' * len(current_playlists))
-                conn.execute(f"""
-                    DELETE FROM playlists 
-                    WHERE id NOT IN ({placeholders})
-                """, list(current_playlists))
-            
-            # Cleanup orphaned playlist_songs entries
-            conn.execute("""
-                DELETE FROM playlist_songs
-                WHERE song_id NOT IN (SELECT id FROM liked_songs)
-                OR playlist_id NOT IN (SELECT id FROM playlists)
-            """)
-            
-            # Get counts after cleanup
-            after_songs = conn.execute("SELECT COUNT(*) FROM liked_songs").fetchone()[0]
-            after_playlists = conn.execute("SELECT COUNT(*) FROM playlists").fetchone()[0]
-            after_memberships = conn.execute("SELECT COUNT(*) FROM playlist_songs").fetchone()[0]
-            
-            print(f"\nCleanup summary:")
-            print(f"- Songs: {before_songs} -> {after_songs} (-{before_songs - after_songs})")
-            print(f"- Playlists: {before_playlists} -> {after_playlists} (-{before_playlists - after_playlists})")
-            print(f"- Memberships: {before_memberships} -> {after_memberships} (-{before_memberships - after_memberships})")
-
-
-
 def main():
+    import envvars
+    from export import export_connection, iter_export
+
     CLIENT_ID = envvars.client_id
     CLIENT_SECRET = envvars.client_secret
     REDIRECT_URI = "http://localhost:8888/callback"
     
-    analyzer = SpotifyAnalyzer(client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI)
+    analyzer = SpotifyAnalyzer(client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI,
+                               max_workers=getattr(envvars, 'max_workers', DEFAULT_MAX_WORKERS))
     
     print("Starting initial data load...")
-    analyzer.fetch_all_liked_songs()
-    analyzer.fetch_all_playlists()
-    
-    print("\nAnalyzing data...")
-    df = analyzer.analyze_songs()
-    
-    print("\nSample of the analysis:")
-    print(df.head())
+    analyzer.fetch_all_liked_songs(full_resync=True)
+    analyzer.fetch_all_playlists(full_resync=True)
     
-    # Export to CSV for further analysis
-    df.to_csv("spotify_analysis.csv", index=False)
+    # Export to CSV for further analysis, streamed straight from the
+    # database rather than built as a DataFrame
+    print("\nExporting data...")
+    with export_connection(analyzer.db_path) as conn, \
+            open("spotify_analysis.csv", "w", encoding="utf-8", newline="") as f:
+        for chunk in iter_export(conn, analyzer.user_id, 'csv'):
+            f.write(chunk)
     print("\nFull analysis exported to spotify_analysis.csv")
 
 if __name__ == "__main__":
@@ -0,0 +1,278 @@
+"""Restore playlists from a backup with as few API calls as possible."""
+
+import argparse
+import logging
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import spotipy
+from spotipy.exceptions import SpotifyException
+from spotipy.oauth2 import SpotifyOAuth
+
+import envvars
+from backup import fetch_playlist_tracks, iter_backup
+from pagination import DEFAULT_MAX_WORKERS, iter_items
+from scheduler import BACKGROUND, DEFAULT_BURST, DEFAULT_RATE, RequestScheduler, request_priority
+from spotify_clients import create_session
+from write_queue import MAX_ITEMS_PER_CALL
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds between two write calls
+MIN_CALL_INTERVAL = 0.1
+
+# Replacing a playlist's tracks resets their added_at dates, so it is only
+# done when the diff would need this many times more calls
+REPLACE_COST_FACTOR = 2
+
+# Rate limited calls are retried this often after waiting out Retry-After
+MAX_RATE_LIMIT_RETRIES = 5
+
+
+def _batches(items: List, size: int = MAX_ITEMS_PER_CALL) -> Iterable[List]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _calls(count: int) -> int:
+    return -(-count // MAX_ITEMS_PER_CALL)
+
+
+def _keyed(track_ids: List[str]) -> List[Tuple[str, int]]:
+    """Tell repeated tracks apart as (id, occurrence) pairs."""
+    seen = Counter()
+    keys = []
+    for track_id in track_ids:
+        keys.append((track_id, seen[track_id]))
+        seen[track_id] += 1
+    return keys
+
+
+def plan_moves(current: List, target: List) -> List[Tuple[int, int, int]]:
+    """Plan reorders that turn ``current`` into ``target``, a permutation of it.
+
+    Walks the target order and moves the longest block that is already in
+    the right order in one call. Returns ``(range_start, insert_before,
+    range_length)`` tuples to apply one after the other.
+    """
+    current = list(current)
+    positions = {key: i for i, key in enumerate(current)}
+    moves = []
+    i = 0
+    while i < len(target):
+        if current[i] == target[i]:
+            i += 1
+            continue
+        start = positions[target[i]]
+        length = 1
+        while (start + length < len(current) and i + length < len(target)
+               and current[start + length] == target[i + length]):
+            length += 1
+        moves.append((start, i, length))
+
+        block = current[start:start + length]
+        del current[start:start + length]
+        current[i:i] = block
+        for position in range(i, start + length):
+            positions[current[position]] = position
+        i += length
+    return moves
+
+
+class PlaylistPlan:
+    """Changes that turn a playlist's current tracks into the backed up ones."""
+
+    def __init__(self, current: List[Optional[str]], target: List[str]):
+        self.target = target
+        current_counts = Counter(current)
+        target_counts = Counter(target)
+
+        # Local files and unavailable tracks, None in ``current``, cannot be
+        # removed or added through the API but still count in Spotify's
+        # positions. They are kept and moved behind the backed up tracks.
+        fixed = [track_id for track_id in current if track_id is None]
+
+        # Tracks to drop, including ones present more often than in the
+        # backup; those are removed entirely and added back
+        self.removes = [
+            track_id for track_id in dict.fromkeys(current)
+            if track_id is not None and current_counts[track_id] > target_counts[track_id]
+        ]
+        removed = set(self.removes)
+
+        kept = _keyed([track_id for track_id in current if track_id not in removed])
+        target_keys = _keyed(target + fixed)
+        kept_keys = set(kept)
+        added = [key for key in target_keys if key not in kept_keys]
+        self.adds = [track_id for track_id, _ in added]
+
+        # Added tracks are appended, then everything is moved into place
+        self.moves = plan_moves(kept + added, target_keys)
+
+        # Replacing would drop the tracks that cannot be added back
+        diff_calls = _calls(len(self.removes)) + _calls(len(self.adds)) + len(self.moves)
+        self.replace = not fixed and diff_calls > REPLACE_COST_FACTOR * max(1, _calls(len(target)))
+
+    @property
+    def calls(self) -> int:
+        if self.replace:
+            return max(1, _calls(len(self.target)))
+        return _calls(len(self.removes)) + _calls(len(self.adds)) + len(self.moves)
+
+    def describe(self) -> str:
+        if self.replace:
+            return f"replace with {len(self.target)} tracks"
+        if not self.calls:
+            return "unchanged"
+        return f"+{len(self.adds)} -{len(self.removes)} {len(self.moves)} moves"
+
+
+class Pacer:
+    """Space out write calls and wait out rate limits."""
+
+    def __init__(self, min_interval: float = MIN_CALL_INTERVAL,
+                 max_retries: int = MAX_RATE_LIMIT_RETRIES):
+        self.min_interval = min_interval
+        self.max_retries = max_retries
+        self.calls = 0
+        self._last_call = 0.0
+
+    def call(self, fn, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            wait = self._last_call + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_call = time.monotonic()
+            self.calls += 1
+            try:
+                return fn(*args, **kwargs)
+            except SpotifyException as e:
+                if e.http_status != 429 or attempt == self.max_retries:
+                    raise
+                retry_after = float((e.headers or {}).get('Retry-After', 1))
+                logger.warning(f"Rate limited, waiting {retry_after:.0f}s")
+                time.sleep(retry_after)
+
+
+def apply_plan(sp, pacer: Pacer, playlist_id: str, plan: PlaylistPlan):
+    """Send a plan to Spotify in batches of up to 100 tracks."""
+    if plan.replace:
+        batches = list(_batches(plan.target)) or [[]]
+        pacer.call(sp.playlist_replace_items, playlist_id, batches[0])
+        for batch in batches[1:]:
+            pacer.call(sp.playlist_add_items, playlist_id, batch)
+        return
+
+    for batch in _batches(plan.removes):
+        pacer.call(sp.playlist_remove_all_occurrences_of_items, playlist_id, batch)
+    for batch in _batches(plan.adds):
+        pacer.call(sp.playlist_add_items, playlist_id, batch)
+    for range_start, insert_before, range_length in plan.moves:
+        pacer.call(sp.playlist_reorder_items, playlist_id,
+                   range_start=range_start, insert_before=insert_before, range_length=range_length)
+
+
+def restore(sp, backup_path: Path, playlist_ids: Optional[List[str]] = None, dry_run: bool = False,
+            create_missing: bool = False, max_workers: int = DEFAULT_MAX_WORKERS,
+            pacer: Optional[Pacer] = None) -> Dict[str, int]:
+    """Bring the user's playlists back to their state in a backup.
+
+    Only playlists owned by the current user can be changed. Playlists whose
+    snapshot_id still matches the backup are skipped without reading them.
+    Backed up playlists that no longer exist are recreated with
+    ``create_missing``. Returns call counts for the report.
+    """
+    pacer = pacer or Pacer()
+    user_id = sp.current_user()['id']
+    current_playlists = {
+        playlist['id']: playlist
+        for playlist in iter_items(
+            lambda offset, limit: sp.current_user_playlists(limit=limit, offset=offset),
+            limit=50,
+            max_workers=max_workers
+        )
+    }
+    stats = Counter()
+
+    for record in iter_backup(backup_path):
+        if record['type'] != 'playlist':
+            continue
+        if playlist_ids and record['id'] not in playlist_ids:
+            continue
+        name = record['name']
+        target = [track_id for track_id, _ in record['tracks']]
+        playlist = current_playlists.get(record['id'])
+
+        if playlist is None:
+            if not create_missing or record['owner_id'] not in (None, user_id):
+                logger.info(f"'{name}': no longer exists, skipped")
+                stats['skipped'] += 1
+                continue
+            plan = PlaylistPlan([], target)
+            logger.info(f"'{name}': recreate with {len(target)} tracks ({plan.calls + 1} calls)")
+            stats['planned_calls'] += plan.calls + 1
+            if not dry_run:
+                created = pacer.call(sp.user_playlist_create, user_id, name, public=False)
+                apply_plan(sp, pacer, created['id'], plan)
+            continue
+
+        if playlist['owner']['id'] != user_id:
+            logger.info(f"'{name}': owned by someone else, skipped")
+            stats['skipped'] += 1
+            continue
+        if record['snapshot_id'] and playlist.get('snapshot_id') == record['snapshot_id']:
+            logger.info(f"'{name}': unchanged since the backup")
+            continue
+
+        current = [
+            track['id'] if track else None
+            for track in fetch_playlist_tracks(sp, record['id'], max_workers, keep_unavailable=True)
+        ]
+        plan = PlaylistPlan(current, target)
+        logger.info(f"'{name}': {plan.describe()} ({plan.calls} calls)")
+        stats['planned_calls'] += plan.calls
+        if plan.calls and not dry_run:
+            apply_plan(sp, pacer, record['id'], plan)
+
+    stats['calls'] = pacer.calls
+    return dict(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('backup', type=Path, help='backup file, .ndjson.gz or the older .json')
+    parser.add_argument('--playlist', action='append', dest='playlist_ids', metavar='ID',
+                        help='only restore this playlist, can be repeated')
+    parser.add_argument('--dry-run', action='store_true', help='only report the changes')
+    parser.add_argument('--create-missing', action='store_true',
+                        help='recreate backed up playlists that were deleted')
+    args = parser.parse_args()
+
+    sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
+        client_id=envvars.client_id,
+        client_secret=envvars.client_secret,
+        redirect_uri="http://localhost:8888/callback",
+        scope="playlist-read-private playlist-modify-public playlist-modify-private"
+    ), requests_session=create_session(scheduler=RequestScheduler(
+        rate=getattr(envvars, 'spotify_rate_limit', DEFAULT_RATE),
+        burst=getattr(envvars, 'spotify_burst', DEFAULT_BURST)
+    )))
+
+    with request_priority(BACKGROUND):
+        stats = restore(
+            sp, args.backup,
+            playlist_ids=args.playlist_ids,
+            dry_run=args.dry_run,
+            create_missing=args.create_missing,
+            max_workers=getattr(envvars, 'max_workers', DEFAULT_MAX_WORKERS)
+        )
+    verb = 'Would make' if args.dry_run else 'Made'
+    logger.info(f"{verb} {stats.get('planned_calls', 0)} write calls, "
+                f"skipped {stats.get('skipped', 0)} playlists")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Shared budget for Spotify API requests, with priorities.
+
+Every request sent through a session from ``spotify_clients.create_session``
+first takes a token from a ``RequestScheduler``. Tokens refill at a fixed
+rate; when they run short, waiting requests are served by priority, and the
+last few tokens are kept for interactive requests. A 429 pauses everyone
+until its ``Retry-After`` has passed.
+
+The priority of a request comes from the context it is made in:
+
+    with request_priority(BACKGROUND):
+        analyzer.fetch_all_playlists()
+"""
+
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+from metrics import REGISTRY, Gauge, Histogram
+
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', NORMAL: 'normal', BACKGROUND: 'background'}
+
+# Spotify does not publish its limit; it is computed over a rolling 30
+# second window, and this stays well below what a single app gets
+DEFAULT_RATE = 10.0
+DEFAULT_BURST = 20
+
+# Tokens that only interactive requests may take
+INTERACTIVE_RESERVE = 3
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar('spotify_request_priority', default=NORMAL)
+
+SCHEDULER_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'spotify_scheduler_queue_depth', 'Spotify requests waiting for a token, by priority', ('priority',)
+))
+SCHEDULER_WAIT = REGISTRY.register(Histogram(
+    'spotify_scheduler_wait_seconds', 'Time Spotify requests waited for a token, by priority', ('priority',)
+))
+
+
+@contextmanager
+def request_priority(priority: int) -> Iterator[None]:
+    """Make the Spotify requests of the block, and of work it hands to
+    ``pagination.map_in_order``, run at ``priority``."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+class RequestScheduler:
+    """Token bucket that hands out request slots by priority.
+
+    ``acquire`` blocks until the caller may send a request and returns how
+    long it waited. ``pause`` stops every request for the given number of
+    seconds, for rate limit responses.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST,
+                 interactive_reserve: int = INTERACTIVE_RESERVE):
+        self.rate = rate
+        self.burst = burst
+        self.interactive_reserve = min(interactive_reserve, burst - 1)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting: List[Tuple[int, int]] = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._sent: Dict[int, int] = {priority: 0 for priority in PRIORITY_NAMES}
+        self._max_wait: Dict[int, float] = {priority: 0.0 for priority in PRIORITY_NAMES}
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _queued(self, priority: int) -> int:
+        return sum(1 for waiting_priority, _ in self._waiting if waiting_priority == priority)
+
+    def acquire(self, priority: int = None) -> float:
+        """Wait for a token at ``priority``, the context's by default."""
+        if priority is None:
+            priority = current_priority()
+        # Lower priorities leave the reserve to interactive requests
+        needed = 1 if priority == INTERACTIVE else 1 + self.interactive_reserve
+        start = time.monotonic()
+        entry = (priority, next(self._order))
+
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            SCHEDULER_QUEUE_DEPTH.set(PRIORITY_NAMES[priority], value=self._queued(priority))
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now < self._paused_until:
+                        delay = self._paused_until - now
+                    elif self._waiting[0] != entry:
+                        # Someone with a higher priority, or earlier, goes first
+                        delay = None
+                    elif self._tokens >= needed:
+                        self._tokens -= 1
+                        break
+                    else:
+                        delay = (needed - self._tokens) / self.rate
+                    self._cond.wait(delay)
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                SCHEDULER_QUEUE_DEPTH.set(PRIORITY_NAMES[priority], value=self._queued(priority))
+                self._cond.notify_all()
+
+        waited = time.monotonic() - start
+        SCHEDULER_WAIT.observe(PRIORITY_NAMES[priority], value=waited)
+        with self._cond:
+            self._sent[priority] += 1
+            self._max_wait[priority] = max(self._max_wait[priority], waited)
+        return waited
+
+    def pause(self, seconds: float):
+        """Hold back every request for ``seconds``, e.g. a 429's Retry-After."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._cond.notify_all()
+
+    def status(self) -> Dict:
+        """Tokens left, pause and per-priority queue depth, sent requests
+        and longest wait."""
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'tokens': round(self._tokens, 2),
+                'paused_for': round(max(0.0, self._paused_until - now), 2),
+                'priorities': {
+                    name: {
+                        'queued': self._queued(priority),
+                        'sent': self._sent[priority],
+                        'max_wait': round(self._max_wait[priority], 3)
+                    }
+                    for priority, name in PRIORITY_NAMES.items()
+                }
+            }
@@ -0,0 +1,207 @@
+"""Long-lived Spotify clients that share one pooled HTTP session."""
+
+import re
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+from spotipy.cache_handler import MemoryCacheHandler
+from spotipy.oauth2 import SpotifyOAuth
+from urllib3.util.retry import Retry
+
+from metrics import SPOTIFY_RETRIES, observe_spotify
+from scheduler import RequestScheduler
+
+# Keep-alive connections kept per host. The app talks to two hosts (the API
+# and the accounts service), but refreshes and backups use several threads.
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+# (connect, read) timeouts in seconds
+REQUEST_TIMEOUT: Tuple[float, float] = (3.05, 10)
+
+# Same retry policy as spotipy's own session. Rate limited calls are
+# retried by InstrumentedAdapter, which knows about the scheduler.
+RETRIES = 3
+RETRY_STATUSES = (500, 502, 503, 504)
+BACKOFF_FACTOR = 0.3
+
+# A 429 asking to wait longer than this is returned to the caller, which
+# surfaces it instead of hanging a request for minutes
+MAX_RETRY_AFTER = 60
+
+# The token endpoint has its own limits and is not throttled
+ACCOUNTS_HOST = 'accounts.spotify.com'
+
+# Spotify ids are 22 base62 characters; user ids can be anything
+_ID_SEGMENT = re.compile(r'^[0-9A-Za-z]{22}$')
+
+
+def endpoint_template(url: str) -> str:
+    """Reduce a request URL to its endpoint, e.g. ``/v1/playlists/{id}/tracks``."""
+    segments = urlparse(url).path.rstrip('/').split('/')
+    for i, segment in enumerate(segments):
+        if _ID_SEGMENT.match(segment) or (i and segments[i - 1] == 'users'):
+            segments[i] = '{id}'
+    return '/'.join(segments) or '/'
+
+
+class CountingRetry(Retry):
+    """Retry policy that counts every retried attempt in the metrics."""
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+        reason = str(response.status) if response is not None and response.status else type(error).__name__
+        SPOTIFY_RETRIES.inc(method or '', endpoint_template(url or ''), reason)
+        return super().increment(method, url, response, error, *args, **kwargs)
+
+
+def _retry_after(response) -> float:
+    try:
+        return max(0.0, float(response.headers.get('Retry-After', 1)))
+    except ValueError:
+        return 1.0
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """HTTP adapter that times each call, retries included, by endpoint.
+
+    With a ``scheduler`` every API call first waits for a token at the
+    priority of the calling context. A 429 pauses the scheduler for its
+    ``Retry-After``, so other callers hold back too, and is then retried.
+    """
+
+    def __init__(self, *args, scheduler: Optional[RequestScheduler] = None, **kwargs):
+        self.scheduler = scheduler
+        super().__init__(*args, **kwargs)
+
+    def _send(self, request, *args, **kwargs):
+        scheduled = self.scheduler is not None and urlparse(request.url).hostname != ACCOUNTS_HOST
+        for attempt in range(RETRIES + 1):
+            if scheduled:
+                self.scheduler.acquire()
+            response = super().send(request, *args, **kwargs)
+            if response.status_code != 429 or attempt == RETRIES:
+                return response
+            retry_after = _retry_after(response)
+            if retry_after > MAX_RETRY_AFTER:
+                return response
+            SPOTIFY_RETRIES.inc(request.method, endpoint_template(request.url), '429')
+            response.close()
+            if scheduled:
+                self.scheduler.pause(retry_after)
+            else:
+                time.sleep(retry_after)
+        return response
+
+    def send(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            response = self._send(request, *args, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            observe_spotify(request.method, endpoint_template(request.url), status,
+                            time.perf_counter() - start)
+
+
+def create_session(pool_maxsize: int = POOL_MAXSIZE,
+                   scheduler: Optional[RequestScheduler] = None) -> requests.Session:
+    """Build a requests session with a sized connection pool and retries.
+
+    Calls and retries are recorded in the metrics. Sessions sharing a
+    ``scheduler`` share its request budget.
+    """
+    retry = CountingRetry(
+        total=RETRIES,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+        status=RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        # Otherwise urllib3 retries 429s itself and the adapter never sees them
+        respect_retry_after_header=False
+    )
+    adapter = InstrumentedAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry,
+        scheduler=scheduler
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class SpotifyClients:
+    """Keep one Spotify client per logged in user.
+
+    Every client shares the same HTTP session, so API calls reuse open
+    connections instead of paying a TCP and TLS handshake each. Tokens live in
+    a memory cache handler rather than the Flask session, which lets the
+    client refresh its token on its own and be used from worker threads.
+    ``token_info`` returns the current token so callers can persist it.
+    ``api_prefix`` points the clients at another Web API base URL, such as
+    the local fake server the benchmarks use.
+    """
+
+    def __init__(self, client_id: str, client_secret: str, redirect_uri: str, scope: str,
+                 http: Optional[requests.Session] = None, timeout=REQUEST_TIMEOUT,
+                 api_prefix: Optional[str] = None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self.scope = scope
+        self.timeout = timeout
+        self.api_prefix = api_prefix
+        self.http = http or create_session()
+        self._clients: Dict[str, spotipy.Spotify] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, token_info: Dict) -> spotipy.Spotify:
+        """Return the client for ``key``, creating it from ``token_info``.
+
+        A newer token than the one the client holds, e.g. after logging in
+        again, replaces it.
+        """
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                auth = SpotifyOAuth(
+                    client_id=self.client_id,
+                    client_secret=self.client_secret,
+                    redirect_uri=self.redirect_uri,
+                    scope=self.scope,
+                    cache_handler=MemoryCacheHandler(token_info),
+                    requests_session=self.http,
+                    requests_timeout=self.timeout,
+                    open_browser=False
+                )
+                client = spotipy.Spotify(
+                    auth_manager=auth,
+                    requests_session=self.http,
+                    requests_timeout=self.timeout
+                )
+                if self.api_prefix:
+                    client.prefix = self.api_prefix
+                self._clients[key] = client
+            else:
+                cache_handler = client.auth_manager.cache_handler
+                cached = cache_handler.get_cached_token() or {}
+                if token_info.get('expires_at', 0) > cached.get('expires_at', 0):
+                    cache_handler.save_token_to_cache(token_info)
+            return client
+
+    def token_info(self, key: str) -> Optional[Dict]:
+        """Return the token a client currently holds, without refreshing it."""
+        with self._lock:
+            client = self._clients.get(key)
+        if client is None:
+            return None
+        return client.auth_manager.cache_handler.get_cached_token()
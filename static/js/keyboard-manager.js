@@ -2,32 +2,38 @@
 import { NavigationManager } from './navigation-manager.js';
 import { PlaybackManager } from './playback-manager.js';
 import { PlaylistManager } from './playlist-manager.js';
+import { SearchManager } from './search-manager.js';
+import { SongGrid } from './song-grid.js';
 import { Utils } from './utils.js';
 
 export const KeyboardManager = {
     handleKeyPress(e) {
         // Ignore if we're in an input field
-        if (e.target.tagName === 'INPUT') return;
-
-        const songRows = Array.from(document.querySelectorAll('tr[id^="song-row-"]'));
-        const currentIndex = songRows.findIndex(row => 
-            row.id === `song-row-${NavigationManager.selectedSongId}`
-        );
+        if (e.target.tagName === 'INPUT' || e.target.tagName === 'SELECT') return;
 
         switch (e.key) {
             case 'ArrowUp':
                 e.preventDefault();
-                if (currentIndex > 0) {
-                    const prevRow = songRows[currentIndex - 1];
-                    NavigationManager.selectRow(prevRow.dataset.songId);
+                if (e.shiftKey) {
+                    NavigationManager.extendSelection(-1);
+                } else {
+                    NavigationManager.selectOffset(-1);
                 }
                 break;
 
             case 'ArrowDown':
                 e.preventDefault();
-                if (currentIndex < songRows.length - 1) {
-                    const nextRow = songRows[currentIndex + 1];
-                    NavigationManager.selectRow(nextRow.dataset.songId);
+                if (e.shiftKey) {
+                    NavigationManager.extendSelection(1);
+                } else {
+                    NavigationManager.selectOffset(1);
+                }
+                break;
+
+            case 'a':
+                if (e.ctrlKey || e.metaKey) {
+                    e.preventDefault();
+                    NavigationManager.selectAll();
                 }
                 break;
 
@@ -38,9 +44,17 @@ export const KeyboardManager = {
                 }
                 break;
 
+            case '/':
+                e.preventDefault();
+                SearchManager.focus();
+                break;
+
             case 'Escape':
                 e.preventDefault();
-                PlaybackManager.stopPlayback();
+                // Clear a multi-row selection before stopping playback
+                if (!NavigationManager.clearSelection()) {
+                    PlaybackManager.stopPlayback();
+                }
                 break;
 
             case 'ArrowLeft':
@@ -57,13 +71,9 @@ export const KeyboardManager = {
                 // Number keys 1-9 for quick playlist toggle
                 if (e.key >= '1' && e.key <= '9') {
                     const playlistIndex = parseInt(e.key) - 1;
-                    if (NavigationManager.selectedSongId) {
-                        const cells = document
-                            .getElementById(`song-row-${NavigationManager.selectedSongId}`)
-                            .querySelectorAll('.playlist-cell');
-                        if (cells[playlistIndex]) {
-                            PlaylistManager.toggleSongInPlaylist(cells[playlistIndex]);
-                        }
+                    const playlistId = SongGrid.columns[playlistIndex];
+                    if (NavigationManager.selectedSongId && playlistId) {
+                        PlaylistManager.toggleSongInPlaylist(NavigationManager.selectedSongId, playlistId);
                     }
                 }
         }
@@ -1,3 +1,5 @@
+import { SongGrid } from './song-grid.js';
+
 export const NavigationManager = {
     selectedSongId: null,
 
@@ -7,35 +9,93 @@ export const NavigationManager = {
     },
 
     setupRowClickHandlers() {
-        document.querySelectorAll('tr[id^="song-row-"]').forEach(row => {
-            row.addEventListener('click', (e) => {
-                if (e.target.tagName !== 'BUTTON' && !e.target.closest('button')) {
-                    const songId = row.dataset.songId;
-                    this.selectRow(songId);
-                }
-            });
+        // Rows are re-rendered while scrolling, so clicks are delegated
+        SongGrid.tbody.addEventListener('click', (e) => {
+            const row = e.target.closest('tr[data-song-id]');
+            if (!row || e.target.tagName === 'BUTTON' || e.target.closest('button')) return;
+
+            const songId = row.dataset.songId;
+            if (e.shiftKey) {
+                this.selectRange(this.selectedSongId, songId);
+            } else if (e.ctrlKey || e.metaKey) {
+                SongGrid.toggleInSelection(songId);
+                this.updateSelectionBar();
+            } else if (!e.target.closest('.playlist-cell')) {
+                this.clearSelection();
+            }
+            this.selectRow(songId);
         });
+
+        document.getElementById('selection-clear')
+            .addEventListener('click', () => this.clearSelection());
+    },
+
+    // Multi-row selection for bulk playlist and like changes
+
+    selectRange(fromId, toId) {
+        const from = SongGrid.indexOf(fromId);
+        const to = SongGrid.indexOf(toId);
+        if (from < 0 || to < 0) return;
+
+        const songIds = SongGrid.songs
+            .slice(Math.min(from, to), Math.max(from, to) + 1)
+            .map(song => song.id);
+        SongGrid.setSelection([...SongGrid.selection, ...songIds]);
+        this.updateSelectionBar();
+    },
+
+    async selectAll() {
+        // Every song matching the search, not just the loaded pages
+        await SongGrid.loadAll();
+        SongGrid.setSelection(SongGrid.songs.map(song => song.id));
+        this.updateSelectionBar();
+    },
+
+    clearSelection() {
+        if (!SongGrid.selection.size) return false;
+        SongGrid.setSelection([]);
+        this.updateSelectionBar();
+        return true;
+    },
+
+    async extendSelection(offset) {
+        const fromId = this.selectedSongId;
+        await this.selectOffset(offset);
+        if (fromId) this.selectRange(fromId, this.selectedSongId);
+    },
+
+    // Songs a playlist change applies to: the selection when it includes
+    // the song, otherwise the song alone
+    targetSongs(songId) {
+        return SongGrid.selection.has(songId) ? [...SongGrid.selection] : [songId];
+    },
+
+    updateSelectionBar() {
+        const count = SongGrid.selection.size;
+        document.getElementById('selection-bar').classList.toggle('hidden', count === 0);
+        document.getElementById('selection-count').textContent =
+            `${count} song${count === 1 ? '' : 's'} selected`;
     },
 
     selectRow(songId) {
-        const prevSelected = document.querySelector('.keyboard-selected');
-        if (prevSelected) {
-            prevSelected.classList.remove('keyboard-selected');
-        }
-        
-        const row = document.getElementById(`song-row-${songId}`);
-        if (row) {
-            row.classList.add('keyboard-selected');
-            this.selectedSongId = songId;
-            row.scrollIntoView({ behavior: 'smooth', block: 'nearest' });
+        if (SongGrid.indexOf(songId) < 0) return;
+        this.selectedSongId = songId;
+        SongGrid.setSelected(songId);
+        SongGrid.scrollToSong(songId);
+    },
+
+    async selectOffset(offset) {
+        const currentIndex = SongGrid.indexOf(this.selectedSongId);
+        const song = await SongGrid.songAt(Math.max(0, currentIndex + offset));
+        if (song) {
+            this.selectRow(song.id);
         }
     },
 
     selectFirstRow() {
-        const firstRow = Array.from(document.querySelectorAll('tr[id^="song-row-"]'))[0];
-        if (firstRow) {
-            this.selectedSongId = firstRow.dataset.songId;
-            this.selectRow(this.selectedSongId);
+        const firstSong = SongGrid.songs[0];
+        if (firstSong) {
+            this.selectRow(firstSong.id);
         }
     }
-};
\ No newline at end of file
+};
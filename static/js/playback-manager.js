@@ -1,9 +1,11 @@
 import { Utils } from './utils.js';
 import { NavigationManager } from './navigation-manager.js';
+import { SongGrid } from './song-grid.js';
 
 export const PlaybackManager = {
     currentlyPlaying: null,
     playbackUpdateInterval: null,
+    eventSource: null,
     updateSongId: null,
 
     async togglePlay(songId) {
@@ -23,13 +25,12 @@ export const PlaybackManager = {
         this.stopPlaybackUpdates();
         
         if (this.currentlyPlaying) {
-            const previousButton = document.querySelector(`#song-row-${this.currentlyPlaying} .play-button`);
-            previousButton.textContent = '▶';
+            SongGrid.setPlayLabel(this.currentlyPlaying, null);
         }
         
         await Utils.apiCall('/api/play', 'POST', { song_id: songId });
         this.updatePlaybackState(songId);
-        await this.markAsPlayed(songId);
+        this.markAsPlayed(songId).catch(error => console.error('Error marking song as played:', error));
         
         this.updateSongId = songId;
         
@@ -46,8 +47,7 @@ export const PlaybackManager = {
             await Utils.apiCall('/api/stop', 'POST').catch(err => console.log('Stop playback failed:', err));
         } finally {
             if (this.currentlyPlaying) {
-                const playButton = document.querySelector(`#song-row-${this.currentlyPlaying} .play-button`);
-                playButton.textContent = '▶';
+                SongGrid.setPlayLabel(this.currentlyPlaying, null);
             }
             this.updatePlaybackState(null);
             this.stopPlaybackUpdates();
@@ -55,81 +55,98 @@ export const PlaybackManager = {
     },
 
     updatePlaybackState(songId) {
-        if (this.currentlyPlaying) {
-            document.getElementById(`song-row-${this.currentlyPlaying}`)
-                .classList.remove('active-song');
-        }
-
         this.currentlyPlaying = songId;
-        if (songId) {
-            document.getElementById(`song-row-${songId}`)
-                .classList.add('active-song');
-        }
+        SongGrid.setActive(songId);
     },
 
     async markAsPlayed(songId) {
         await Utils.apiCall('/api/mark_played', 'POST', { song_id: songId });
-        document.getElementById(`song-row-${songId}`).classList.add('played');
+        SongGrid.markPlayed(songId);
     },
 
     startPlaybackUpdates() {
-        if (this.playbackUpdateInterval) {
-            clearInterval(this.playbackUpdateInterval);
+        this.closeUpdateChannels();
+        this._notPlayingCount = 0;
+
+        // The server pushes status changes; poll only if streaming is unavailable
+        if (window.EventSource) {
+            this.eventSource = new EventSource('/api/playback_stream');
+            this.eventSource.onmessage = (event) => this.handlePlaybackStatus(JSON.parse(event.data));
+            this.eventSource.onerror = () => {
+                if (this.eventSource && this.eventSource.readyState === EventSource.CLOSED) {
+                    this.startPolling();
+                }
+            };
+        } else {
+            this.startPolling();
         }
+    },
+
+    startPolling() {
+        this.closeUpdateChannels();
         this.updatePlaybackStatus();
         this.playbackUpdateInterval = setInterval(() => this.updatePlaybackStatus(), 1000);
     },
 
-    stopPlaybackUpdates() {
-        this.updateSongId = null;
+    closeUpdateChannels() {
+        if (this.eventSource) {
+            this.eventSource.close();
+            this.eventSource = null;
+        }
         if (this.playbackUpdateInterval) {
             clearInterval(this.playbackUpdateInterval);
             this.playbackUpdateInterval = null;
         }
     },
 
+    stopPlaybackUpdates() {
+        this.updateSongId = null;
+        this.closeUpdateChannels();
+    },
+
     async updatePlaybackStatus() {
         if (!this.updateSongId) return;
         
         try {
-            const data = await Utils.apiCall('/api/playback_status');
-            if (!this.updateSongId) return;
-            
-            const playButton = document.querySelector(`#song-row-${this.updateSongId} .play-button`);
-            if (!playButton) return;
-            
-            if (data.is_playing) {
-                const progressText = `(${Utils.formatTime(data.progress_ms)}/${Utils.formatTime(data.duration_ms)})`;
-                playButton.innerHTML = `<div class="flex justify-center items-center w-full h-full"><span class="text-xs text-gray-800 dark:text-white">${progressText}</span></div>`;
-                
-                // Only stop if we've reached the end of the song
-                if (data.progress_ms >= data.duration_ms) {
-                    this.stopPlayback();
-                }
-            } else {
-                // Don't automatically stop playback - Spotify might still be starting playback
-                // Only update the UI to show the play button
-                playButton.textContent = '▶';
-                
-                // Check if playback has been stopped by user in Spotify app
-                // Only stop our tracking after multiple consecutive "not playing" responses
-                if (!this._notPlayingCount) {
-                    this._notPlayingCount = 1;
-                } else {
-                    this._notPlayingCount++;
-                    // After 3 consecutive "not playing" responses, assume playback has stopped
-                    if (this._notPlayingCount > 3) {
-                        this.stopPlayback();
-                        this._notPlayingCount = 0;
-                    }
-                }
-            }
+            this.handlePlaybackStatus(await Utils.apiCall('/api/playback_status'));
         } catch (error) {
             console.error('Error updating playback status:', error);
             if (this.updateSongId) {
-                const playButton = document.querySelector(`#song-row-${this.updateSongId} .play-button`);
-                if (playButton) {
-                    playButton.textContent = '▶';
+                SongGrid.setPlayLabel(this.updateSongId, null);
+            }
+        }
+    },
+
+    handlePlaybackStatus(data) {
+        if (!this.updateSongId) return;
+
+        if (data.is_playing) {
+            this._notPlayingCount = 0;
+            const progressText = `(${Utils.formatTime(data.progress_ms)}/${Utils.formatTime(data.duration_ms)})`;
+            SongGrid.setPlayLabel(
+                this.updateSongId,
+                `<div class="flex justify-center items-center w-full h-full"><span class="text-xs text-gray-800 dark:text-white">${progressText}</span></div>`
+            );
+            
+            // Only stop if we've reached the end of the song
+            if (data.progress_ms >= data.duration_ms) {
+                this.stopPlayback();
+            }
+        } else {
+            // Don't automatically stop playback - Spotify might still be starting playback
+            // Only update the UI to show the play button
+            SongGrid.setPlayLabel(this.updateSongId, null);
+            
+            // Check if playback has been stopped by user in Spotify app
+            // Only stop our tracking after multiple consecutive "not playing" responses
+            if (!this._notPlayingCount) {
+                this._notPlayingCount = 1;
+            } else {
+                this._notPlayingCount++;
+                // After 3 consecutive "not playing" responses, assume playback has stopped
+                if (this._notPlayingCount > 3) {
+                    this.stopPlayback();
+                    this._notPlayingCount = 0;
                 }
             }
         }
@@ -1,40 +1,67 @@
-
 import { Utils } from './utils.js';
+import { SongGrid } from './song-grid.js';
+import { NavigationManager } from './navigation-manager.js';
+
+// Songs sent per bulk request, the server's MAX_BULK_SONGS
+const BULK_CHUNK_SIZE = 10000;
 
 export const PlaylistManager = {
-    async toggleSongInPlaylist(cell) {
-        const songId = cell.dataset.songId;
-        const playlistId = cell.dataset.playlistId;
-        
+    async toggleSongInPlaylist(songId, playlistId) {
+        const songIds = NavigationManager.targetSongs(songId);
+        if (songIds.length > 1) {
+            // Selected songs all follow the toggled song's new state
+            return this.setForSongs(songIds, playlistId, !SongGrid.isInPlaylist(songId, playlistId));
+        }
         try {
             if (playlistId === 'liked_songs') {
-                await this.toggleLikedStatus(cell, songId);
+                await this.toggleLikedStatus(songId);
             } else {
-                await this.togglePlaylistStatus(cell, songId, playlistId);
+                await this.togglePlaylistStatus(songId, playlistId);
             }
         } catch (error) {
             alert('Failed to update playlist. Please try again.');
         }
     },
 
-    async toggleLikedStatus(cell, songId) {
-        const endpoint = cell.classList.contains('in-playlist') ? 
-            '/api/unlike_song' : '/api/like_song';
+    async toggleLikedStatus(songId) {
+        const liked = SongGrid.isInPlaylist(songId, 'liked_songs');
+        const endpoint = liked ? '/api/unlike_song' : '/api/like_song';
         
         await Utils.apiCall(endpoint, 'POST', { song_id: songId });
-        this.updateCellStatus(cell);
+        SongGrid.setInPlaylist(songId, 'liked_songs', !liked);
     },
 
-    async togglePlaylistStatus(cell, songId, playlistId) {
-        await Utils.apiCall('/api/toggle_playlist', 'POST', {
+    async togglePlaylistStatus(songId, playlistId) {
+        const data = await Utils.apiCall('/api/toggle_playlist', 'POST', {
             song_id: songId,
             playlist_id: playlistId
         });
-        this.updateCellStatus(cell);
+        SongGrid.setInPlaylist(songId, playlistId, data.in_playlist);
     },
 
-    updateCellStatus(cell) {
-        cell.classList.toggle('in-playlist');
-        cell.textContent = cell.classList.contains('in-playlist') ? '✓' : '+';
+    async setForSongs(songIds, playlistId, inPlaylist) {
+        try {
+            // A whole library selected with Ctrl+A goes out in several requests
+            for (let start = 0; start < songIds.length; start += BULK_CHUNK_SIZE) {
+                const chunk = songIds.slice(start, start + BULK_CHUNK_SIZE);
+                if (playlistId === 'liked_songs') {
+                    await Utils.apiCall('/api/bulk/liked', 'POST', {
+                        song_ids: chunk,
+                        liked: inPlaylist
+                    });
+                } else {
+                    await Utils.apiCall('/api/bulk/playlists', 'POST', {
+                        song_ids: chunk,
+                        playlist_ids: [playlistId],
+                        in_playlist: inPlaylist
+                    });
+                }
+                for (const songId of chunk) {
+                    SongGrid.setInPlaylist(songId, playlistId, inPlaylist);
+                }
+            }
+        } catch (error) {
+            alert('Failed to update the selected songs. Please try again.');
+        }
     }
-};
\ No newline at end of file
+};
@@ -0,0 +1,56 @@
+import { NavigationManager } from './navigation-manager.js';
+import { SongGrid } from './song-grid.js';
+
+// Wait this long after the last keystroke before searching
+const SEARCH_DELAY_MS = 200;
+
+export const SearchManager = {
+    timer: null,
+
+    init() {
+        this.input = document.getElementById('search-input');
+        this.select = document.getElementById('search-filter');
+        this.sort = document.getElementById('search-sort');
+
+        this.input.addEventListener('input', () => {
+            clearTimeout(this.timer);
+            this.timer = setTimeout(() => this.apply(), SEARCH_DELAY_MS);
+        });
+        this.input.addEventListener('keydown', (e) => {
+            if (e.key === 'Escape' || e.key === 'Enter') this.input.blur();
+        });
+        for (const select of [this.select, this.sort]) {
+            select.addEventListener('change', () => {
+                this.apply();
+                select.blur();
+            });
+        }
+    },
+
+    focus() {
+        this.input.focus();
+        this.input.select();
+    },
+
+    buildFilter() {
+        const filter = {};
+        const query = this.input.value.trim();
+        if (query) filter.q = query;
+
+        // Filter options are "<parameter>" or "<parameter>:<value>"
+        const [name, value] = this.select.value.split(':');
+        if (name) filter[name] = value || 1;
+
+        // Sort options are "<sort>" or "<sort>:asc"
+        const [sort, order] = this.sort.value.split(':');
+        if (sort !== 'added') filter.sort = sort;
+        if (order) filter.order = order;
+        return filter;
+    },
+
+    async apply() {
+        clearTimeout(this.timer);
+        await SongGrid.setFilter(this.buildFilter());
+        NavigationManager.selectFirstRow();
+    }
+};
@@ -0,0 +1,341 @@
+import { Utils } from './utils.js';
+
+// Rows rendered above and below the visible area
+const OVERSCAN = 10;
+// Start loading the next page this many rows before the end
+const PREFETCH_ROWS = 50;
+
+export const SongGrid = {
+    songs: [],
+    indexById: new Map(),
+    columns: [],
+    nextCursor: null,
+    hasMore: true,
+    loading: null,
+    // Sort and search parameters; the grid lists all liked songs when empty
+    filter: {},
+    generation: 0,
+    rowHeight: 41,
+    pageSize: 200,
+    selectedId: null,
+    // Songs picked for bulk changes with ctrl/shift clicks
+    selection: new Set(),
+    activeId: null,
+    playLabels: new Map(),
+    renderPending: false,
+
+    async init() {
+        this.container = document.getElementById('table-container');
+        this.tbody = document.getElementById('song-rows');
+        this.thead = this.container.querySelector('thead');
+        this.pageSize = parseInt(this.container.dataset.pageSize) || this.pageSize;
+        this.columns = Array.from(this.thead.querySelectorAll('th[data-playlist-id]'))
+            .map(th => th.dataset.playlistId);
+
+        this.container.addEventListener('scroll', () => this.scheduleRender());
+        window.addEventListener('resize', () => this.scheduleRender());
+
+        await this.loadMore();
+    },
+
+    // Data
+
+    async loadMore() {
+        if (!this.hasMore) return;
+        if (this.loading) return this.loading;
+
+        const generation = this.generation;
+        const loading = (async () => {
+            const params = new URLSearchParams({ limit: this.pageSize, ...this.filter });
+            if (this.nextCursor) params.set('cursor', this.nextCursor);
+
+            const data = await Utils.apiCall(`/api/songs?${params}`);
+            // The filter changed while this page was loading
+            if (generation !== this.generation) return;
+
+            for (const [id, name, artist, playCount, mask, lastPlayedAt] of data.songs) {
+                this.indexById.set(id, this.songs.length);
+                this.songs.push({
+                    id,
+                    name,
+                    artist,
+                    played: playCount > 0,
+                    playCount,
+                    lastPlayedAt,
+                    liked: true,
+                    playlists: this.decodeMask(mask, data.playlists)
+                });
+            }
+            this.nextCursor = data.next_cursor;
+            this.hasMore = Boolean(data.next_cursor);
+        })();
+        this.loading = loading;
+
+        try {
+            await loading;
+        } finally {
+            if (this.loading === loading) this.loading = null;
+        }
+        if (generation === this.generation) this.render();
+    },
+
+    async setFilter(filter) {
+        this.generation++;
+        this.filter = filter;
+        this.songs = [];
+        this.indexById = new Map();
+        this.nextCursor = null;
+        this.hasMore = true;
+        this.loading = null;
+        this.setSelection([]);
+        this.container.scrollTop = 0;
+        await this.loadMore();
+    },
+
+    decodeMask(mask, playlistIds) {
+        const playlists = new Set();
+        let bits = BigInt(`0x${mask}`);
+        for (let i = 0; bits > 0n; i++, bits >>= 1n) {
+            if (bits & 1n) playlists.add(playlistIds[i]);
+        }
+        return playlists;
+    },
+
+    getSong(songId) {
+        const index = this.indexById.get(songId);
+        return index === undefined ? null : this.songs[index];
+    },
+
+    indexOf(songId) {
+        const index = this.indexById.get(songId);
+        return index === undefined ? -1 : index;
+    },
+
+    async loadAll() {
+        while (this.hasMore) {
+            await this.loadMore();
+        }
+    },
+
+    async songAt(index) {
+        while (index >= this.songs.length && this.hasMore) {
+            await this.loadMore();
+        }
+        return this.songs[index] || null;
+    },
+
+    isInPlaylist(songId, playlistId) {
+        const song = this.getSong(songId);
+        if (!song) return false;
+        return playlistId === 'liked_songs' ? song.liked : song.playlists.has(playlistId);
+    },
+
+    setInPlaylist(songId, playlistId, inPlaylist) {
+        const song = this.getSong(songId);
+        if (!song) return;
+        if (playlistId === 'liked_songs') {
+            song.liked = inPlaylist;
+        } else if (inPlaylist) {
+            song.playlists.add(playlistId);
+        } else {
+            song.playlists.delete(playlistId);
+        }
+        const cell = this.findCell(songId, playlistId);
+        if (cell) this.updateCell(cell, inPlaylist);
+    },
+
+    // Row state shared with the other managers
+
+    setSelected(songId) {
+        this.toggleRowClass(this.selectedId, 'keyboard-selected', false);
+        this.selectedId = songId;
+        this.toggleRowClass(songId, 'keyboard-selected', true);
+    },
+
+    setSelection(songIds) {
+        for (const songId of this.selection) {
+            this.toggleRowClass(songId, 'multi-selected', false);
+        }
+        this.selection = new Set(songIds);
+        for (const songId of this.selection) {
+            this.toggleRowClass(songId, 'multi-selected', true);
+        }
+    },
+
+    toggleInSelection(songId) {
+        const selected = !this.selection.has(songId);
+        if (selected) {
+            this.selection.add(songId);
+        } else {
+            this.selection.delete(songId);
+        }
+        this.toggleRowClass(songId, 'multi-selected', selected);
+    },
+
+    setActive(songId) {
+        this.toggleRowClass(this.activeId, 'active-song', false);
+        this.activeId = songId;
+        this.toggleRowClass(songId, 'active-song', true);
+    },
+
+    markPlayed(songId) {
+        const song = this.getSong(songId);
+        if (song) {
+            song.played = true;
+            song.playCount += 1;
+            song.lastPlayedAt = new Date().toISOString().slice(0, 19).replace('T', ' ');
+        }
+        this.toggleRowClass(songId, 'played', true);
+        const button = this.findRow(songId)?.querySelector('.play-button');
+        if (button && song) button.title = this.describePlays(song);
+    },
+
+    describePlays(song) {
+        if (!song.playCount) return 'Never played';
+        const times = song.playCount === 1 ? 'once' : `${song.playCount} times`;
+        return `Played ${times}, last on ${song.lastPlayedAt.slice(0, 10)}`;
+    },
+
+    setPlayLabel(songId, html) {
+        if (html) {
+            this.playLabels.set(songId, html);
+        } else {
+            this.playLabels.delete(songId);
+        }
+        const button = this.findRow(songId)?.querySelector('.play-button');
+        if (button) button.innerHTML = html || '▶';
+    },
+
+    // DOM
+
+    findRow(songId) {
+        return songId ? document.getElementById(`song-row-${songId}`) : null;
+    },
+
+    findCell(songId, playlistId) {
+        const row = this.findRow(songId);
+        const column = this.columns.indexOf(playlistId);
+        return row && column >= 0 ? row.querySelectorAll('.playlist-cell')[column] : null;
+    },
+
+    toggleRowClass(songId, className, force) {
+        const row = this.findRow(songId);
+        if (row) row.classList.toggle(className, force);
+    },
+
+    scrollToSong(songId) {
+        const index = this.indexOf(songId);
+        if (index < 0) return;
+
+        const headerHeight = this.thead.offsetHeight;
+        const top = headerHeight + index * this.rowHeight;
+        const viewTop = this.container.scrollTop + headerHeight;
+        const viewBottom = this.container.scrollTop + this.container.clientHeight;
+
+        if (top < viewTop) {
+            this.container.scrollTop = top - headerHeight;
+        } else if (top + this.rowHeight > viewBottom) {
+            this.container.scrollTop = top + this.rowHeight - this.container.clientHeight;
+        }
+        this.render();
+    },
+
+    scheduleRender() {
+        if (this.renderPending) return;
+        this.renderPending = true;
+        requestAnimationFrame(() => {
+            this.renderPending = false;
+            this.render();
+        });
+    },
+
+    render() {
+        const headerHeight = this.thead.offsetHeight;
+        const scrollTop = Math.max(0, this.container.scrollTop);
+        const viewHeight = this.container.clientHeight - headerHeight;
+
+        const first = Math.max(0, Math.floor(scrollTop / this.rowHeight) - OVERSCAN);
+        const last = Math.min(
+            this.songs.length,
+            Math.ceil((scrollTop + viewHeight) / this.rowHeight) + OVERSCAN
+        );
+
+        const fragment = document.createDocumentFragment();
+        fragment.appendChild(this.createSpacer(first * this.rowHeight));
+        for (let i = first; i < last; i++) {
+            fragment.appendChild(this.createRow(this.songs[i]));
+        }
+        fragment.appendChild(this.createSpacer((this.songs.length - last) * this.rowHeight));
+        this.tbody.replaceChildren(fragment);
+
+        this.measureRowHeight();
+
+        if (this.hasMore && last >= this.songs.length - PREFETCH_ROWS) {
+            this.loadMore();
+        }
+    },
+
+    measureRowHeight() {
+        const row = this.tbody.querySelector('tr[data-song-id]');
+        if (row && row.offsetHeight && row.offsetHeight !== this.rowHeight) {
+            this.rowHeight = row.offsetHeight;
+            this.scheduleRender();
+        }
+    },
+
+    createSpacer(height) {
+        const spacer = document.createElement('tr');
+        spacer.className = 'grid-spacer';
+        const cell = document.createElement('td');
+        cell.colSpan = 3 + this.columns.length;
+        cell.style.height = `${height}px`;
+        spacer.appendChild(cell);
+        return spacer;
+    },
+
+    createRow(song) {
+        const row = document.createElement('tr');
+        row.id = `song-row-${song.id}`;
+        row.dataset.songId = song.id;
+        row.className = 'border-t song-row';
+        row.classList.toggle('played', song.played);
+        row.classList.toggle('keyboard-selected', song.id === this.selectedId);
+        row.classList.toggle('multi-selected', this.selection.has(song.id));
+        row.classList.toggle('active-song', song.id === this.activeId);
+
+        const playCell = document.createElement('td');
+        playCell.className = 'px-4 py-2 text-center sticky-col play-col';
+        const button = document.createElement('button');
+        button.className = 'play-button text-gray-600 dark:text-gray-400 hover:text-gray-800 dark:hover:text-gray-200';
+        button.innerHTML = this.playLabels.get(song.id) || '▶';
+        button.title = this.describePlays(song);
+        playCell.appendChild(button);
+        row.appendChild(playCell);
+
+        row.appendChild(this.createTextCell(song.name, 'song-col w-[200px]'));
+        row.appendChild(this.createTextCell(song.artist, 'artist-col w-[150px]'));
+
+        for (const playlistId of this.columns) {
+            const cell = document.createElement('td');
+            cell.className = 'px-2 py-2 text-center playlist-cell w-[100px] max-w-[100px]';
+            cell.dataset.songId = song.id;
+            cell.dataset.playlistId = playlistId;
+            this.updateCell(cell, this.isInPlaylist(song.id, playlistId));
+            row.appendChild(cell);
+        }
+        return row;
+    },
+
+    createTextCell(text, columnClass) {
+        const cell = document.createElement('td');
+        cell.className = `px-4 py-2 sticky-col truncate ${columnClass}`;
+        cell.title = text;
+        cell.textContent = text;
+        return cell;
+    },
+
+    updateCell(cell, inPlaylist) {
+        cell.classList.toggle('in-playlist', inPlaylist);
+        cell.textContent = inPlaylist ? '✓' : '+';
+    }
+};
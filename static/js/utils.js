@@ -25,27 +25,61 @@ export const Utils = {
         }
     },
     
+    refreshJobId: null,
+
     async refreshData() {
+        const button = document.getElementById('refresh-button');
+
+        // Clicking again while a refresh runs cancels it
+        if (this.refreshJobId) {
+            button.textContent = 'Cancelling...';
+            await this.apiCall(`/api/refresh/${this.refreshJobId}/cancel`, 'POST')
+                .catch(error => console.error('Error cancelling refresh:', error));
+            return;
+        }
+
         try {
-            // Update button to show loading state
-            const button = document.getElementById('refresh-button');
-            const originalText = button.textContent;
             button.textContent = 'Refreshing...';
-            button.disabled = true;
-            
-            // Call the refresh API endpoint
-            await this.apiCall('/api/refresh', 'POST');
-            
-            // Reload the page to see the updated data
-            window.location.reload();
+            button.title = 'Click to cancel';
+
+            // The refresh runs in the background, follow its progress
+            let job = await this.apiCall('/api/refresh', 'POST');
+            this.refreshJobId = job.job_id;
+            while (job.status === 'running') {
+                if (button.textContent !== 'Cancelling...') {
+                    button.textContent = this.describeRefresh(job);
+                }
+                await new Promise(resolve => setTimeout(resolve, 1000));
+                job = await this.apiCall(`/api/refresh/${job.job_id}`);
+            }
+            if (job.status === 'failed') throw new Error(job.error);
+
+            if (job.status === 'done') {
+                // Reload the page to see the updated data
+                window.location.reload();
+                return;
+            }
         } catch (error) {
             console.error('Error refreshing data:', error);
             alert('Failed to refresh data from Spotify. Please try again.');
-            
-            // Reset button state
-            const button = document.getElementById('refresh-button');
-            button.textContent = 'Refresh Data';
-            button.disabled = false;
+        }
+
+        // Reset button state
+        this.refreshJobId = null;
+        button.textContent = 'Refresh Data';
+        button.title = '';
+    },
+
+    describeRefresh({ stage, counts }) {
+        switch (stage) {
+            case 'liked_songs':
+                return `Liked songs (${counts.liked_songs || 0})...`;
+            case 'playlists':
+                return counts.playlists_total
+                    ? `Playlists (${counts.playlists_done || 0}/${counts.playlists_total})...`
+                    : 'Playlists...';
+            default:
+                return 'Refreshing...';
         }
     }
 };
\ No newline at end of file
@@ -0,0 +1,219 @@
+"""Write-behind queue that batches playlist toggles into Spotify API calls."""
+
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from spotipy.exceptions import SpotifyException
+
+from scheduler import INTERACTIVE, request_priority
+
+# Spotify accepts at most 100 items per playlist add/remove call
+MAX_ITEMS_PER_CALL = 100
+
+# Seconds the worker waits after the first toggle so bursts share one call
+FLUSH_DELAY = 0.5
+
+MAX_ATTEMPTS = 5
+BASE_BACKOFF = 1.0
+
+# Number of permanently failed operations kept for the status report
+MAX_REPORTED_FAILURES = 50
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Rate limits, server errors and network errors are worth retrying."""
+    if isinstance(error, SpotifyException):
+        return error.http_status == 429 or error.http_status >= 500
+    return True
+
+
+class PlaylistWriteQueue:
+    """Apply playlist toggles to Spotify in the background.
+
+    ``enqueue`` records the new state of a (playlist, song) pair and returns
+    at once. A toggle that reverses a pair which has not been sent yet cancels
+    it. A worker thread waits ``flush_delay`` seconds to collect a burst, then
+    sends every playlist's removes and adds in calls of up to 100 items,
+    each with the client of the session that made the toggle.
+    Failed calls are retried with exponential backoff. Operations that still
+    fail are passed to ``on_failure(playlist_id, song_ids, added)`` so the
+    caller can roll back its local state.
+    """
+
+    def __init__(self, on_failure: Optional[Callable[[str, List[str], bool], Any]] = None,
+                 flush_delay: float = FLUSH_DELAY, max_attempts: int = MAX_ATTEMPTS,
+                 base_backoff: float = BASE_BACKOFF):
+        self.on_failure = on_failure
+        self.flush_delay = flush_delay
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+
+        self._cond = threading.Condition()
+        self._flush_now = threading.Event()
+        # playlist id -> song id -> (add, client that enqueued it)
+        self._pending: Dict[str, Dict[str, Tuple[bool, Any]]] = {}
+        self._in_flight = 0
+        self._failures = deque(maxlen=MAX_REPORTED_FAILURES)
+        self._last_error: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def enqueue(self, client, playlist_id: str, song_id: str, add: bool):
+        """Queue adding (``add=True``) or removing a song from a playlist.
+
+        ``client`` is the Spotify client the worker sends this toggle with;
+        it must not depend on the request context.
+        """
+        self.enqueue_many(client, playlist_id, [song_id], add)
+
+    def enqueue_many(self, client, playlist_id: str, song_ids: List[str], add: bool):
+        """Queue the same change for several songs of a playlist at once."""
+        with self._cond:
+            ops = self._pending.setdefault(playlist_id, {})
+            for song_id in song_ids:
+                if song_id in ops and ops[song_id][0] != add:
+                    # The pair is back in its remote state, nothing to send
+                    del ops[song_id]
+                else:
+                    ops[song_id] = (add, client)
+            if not ops:
+                del self._pending[playlist_id]
+
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='playlist-write-queue', daemon=True
+                )
+                self._thread.start()
+            self._cond.notify_all()
+
+    def status(self) -> Dict[str, Any]:
+        """Report unflushed, in-flight and failed operations."""
+        with self._cond:
+            return {
+                'pending': sum(len(ops) for ops in self._pending.values()),
+                'pending_by_playlist': {
+                    playlist_id: {
+                        'add': [song_id for song_id, (add, _) in ops.items() if add],
+                        'remove': [song_id for song_id, (add, _) in ops.items() if not add]
+                    }
+                    for playlist_id, ops in self._pending.items()
+                },
+                'in_flight': self._in_flight,
+                'failed': list(self._failures),
+                'last_error': self._last_error
+            }
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """Flush immediately and wait until nothing is pending or in flight."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                self._flush_now.set()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _run(self):
+        # The toggles were clicked by the user, so their calls go first
+        try:
+            with request_priority(INTERACTIVE):
+                self._work()
+        finally:
+            # Should the worker die anyway, the next toggle starts a new one
+            with self._cond:
+                self._thread = None
+                self._in_flight = 0
+                self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+
+            # Let a burst of toggles accumulate before sending
+            self._flush_now.wait(self.flush_delay)
+            self._flush_now.clear()
+
+            with self._cond:
+                batch, self._pending = self._pending, {}
+                self._in_flight = sum(len(ops) for ops in batch.values())
+
+            try:
+                for playlist_id, ops in batch.items():
+                    try:
+                        self._flush_playlist(playlist_id, ops)
+                    except Exception as e:
+                        # Keep the worker alive for the other playlists
+                        print(f"Flushing playlist {playlist_id} failed: {e}")
+                        self._record_failures(playlist_id, ops, e)
+            finally:
+                with self._cond:
+                    self._in_flight = 0
+                    self._cond.notify_all()
+
+    def _flush_playlist(self, playlist_id: str, ops: Dict[str, Tuple[bool, Any]]):
+        # Toggles from different sessions are sent with their own clients
+        by_client: Dict[int, Tuple[Any, List[str], List[str]]] = {}
+        for song_id, (add, client) in ops.items():
+            _, adds, removes = by_client.setdefault(id(client), (client, [], []))
+            (adds if add else removes).append(song_id)
+
+        for client, adds, removes in by_client.values():
+            for start in range(0, len(removes), MAX_ITEMS_PER_CALL):
+                chunk = removes[start:start + MAX_ITEMS_PER_CALL]
+                self._send(playlist_id, chunk, False, lambda: client.playlist_remove_all_occurrences_of_items(
+                    playlist_id=playlist_id, items=chunk
+                ))
+            for start in range(0, len(adds), MAX_ITEMS_PER_CALL):
+                chunk = adds[start:start + MAX_ITEMS_PER_CALL]
+                self._send(playlist_id, chunk, True, lambda: client.playlist_add_items(
+                    playlist_id=playlist_id, items=chunk
+                ))
+
+    def _record_failures(self, playlist_id: str, ops: Dict[str, Tuple[bool, Any]], error: Exception):
+        with self._cond:
+            self._last_error = str(error)
+            for song_id, (add, _) in ops.items():
+                self._failures.append({
+                    'playlist_id': playlist_id,
+                    'song_id': song_id,
+                    'action': 'add' if add else 'remove',
+                    'error': self._last_error
+                })
+
+    def _send(self, playlist_id: str, song_ids: List[str], add: bool, call: Callable):
+        for attempt in range(self.max_attempts):
+            try:
+                call()
+                return
+            except Exception as e:
+                print(f"Playlist write to {playlist_id} failed (attempt {attempt + 1}): {e}")
+                with self._cond:
+                    self._last_error = str(e)
+                if not _is_retryable(e) or attempt == self.max_attempts - 1:
+                    break
+                time.sleep(self.base_backoff * 2 ** attempt)
+
+        with self._cond:
+            # A newer toggle of the same pair supersedes the failed one
+            pending = self._pending.get(playlist_id, {})
+            failed = [song_id for song_id in song_ids if song_id not in pending]
+            for song_id in failed:
+                self._failures.append({
+                    'playlist_id': playlist_id,
+                    'song_id': song_id,
+                    'action': 'add' if add else 'remove',
+                    'error': self._last_error
+                })
+        if failed and self.on_failure:
+            try:
+                self.on_failure(playlist_id, failed, add)
+            except Exception as e:
+                # The failures are recorded above, the rollback is lost
+                print(f"Rolling back failed writes to {playlist_id} failed: {e}")
+                with self._cond:
+                    self._last_error = str(e)